@@ -0,0 +1,302 @@
+import os
+import time
+import asyncio
+import logging
+
+import aiohttp
+
+from spider import BizhiSpider, IncompleteDownload
+from httpcache import NOT_MODIFIED, conditional_headers
+from extract import DEFAULT_EXTRACTOR
+from metrics import Reporter, serve as serve_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBizhiSpider(BizhiSpider):
+    """
+    基于asyncio的爬虫, 网页与图片并发请求, 请求速率由按主机的令牌桶限制
+
+    页面解析、URL处理沿用BizhiSpider
+    """
+
+    def __init__(self, base_url="https://www.bizhi99.com/2560x1600", download_dir="E:\\just-ads\\Pictures",
+                 max_pages=21, rate=2, burst=2, concurrency=10, index_path=None,
+                 extractor=DEFAULT_EXTRACTOR, image_host="https://pic.dmjnb.com", cache_path=None,
+                 image_rate=None, image_burst=None):
+        """
+        Args:
+            base_url: 目标网页URL
+            download_dir: 图片下载目录
+            max_pages: 最大翻页数限制
+            rate: 列表页每个主机每秒的请求数
+            burst: 列表页每个主机允许的瞬时突发请求数
+            concurrency: 同时进行的请求数上限, 图片下载数在其内自动调整
+            index_path: 图片索引数据库路径, 默认为下载目录下的index.db
+            extractor: 图片地址的提取后端, 见extract.EXTRACTORS, 默认为stream, 结果与bs4一致
+            image_host: 图片所在的主机, 只下载该主机上的图片
+            cache_path: 列表页缓存数据库路径, 默认为下载目录下的pages.db
+            image_rate: 图片每个主机每秒的请求数, 默认不限
+            image_burst: 图片每个主机允许的瞬时突发请求数, 默认为image_rate
+        """
+        super().__init__(base_url, download_dir, max_pages, rate, burst, index_path, extractor, image_host,
+                         cache_path, image_rate, image_burst)
+        self.concurrency = concurrency
+
+    async def request_page_async(self, session, url, cached=None):
+        """
+        获取网页内容, 给出缓存条目时发送条件请求
+
+        Args:
+            session: aiohttp会话
+            url: 要访问的URL
+            cached: PageCache.get返回的缓存条目
+
+        Returns:
+            (网页内容, (ETag, Last-Modified)), 未修改时网页内容为NOT_MODIFIED, 失败时为None
+        """
+        try:
+            logger.debug(f"正在访问网页: {url}")
+            await self.limiter.acquire_async(url)
+            async with self.semaphore:
+                start = time.monotonic()
+                async with session.get(url, headers=conditional_headers(cached),
+                                       timeout=aiohttp.ClientTimeout(total=30)) as response:
+                    self.metrics.inc('requests_total', kind='page', status=response.status)
+                    if response.status == 304 and cached:
+                        self.metrics.inc('pages_total')
+                        self.metrics.inc('pages_not_modified_total')
+                        return NOT_MODIFIED, None
+                    response.raise_for_status()
+                    body = await response.read()
+                self.metrics.observe('page_fetch_seconds', time.monotonic() - start)
+            # 与requests一致, 未声明编码时按utf-8解码
+            text = body.decode(response.charset or 'utf-8', errors='replace')
+            self.metrics.inc('pages_total')
+            logger.debug("网页获取成功")
+            return text, (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if not isinstance(e, aiohttp.ClientResponseError):
+                self.metrics.inc('requests_total', kind='page', status='error')
+            logger.error(f"获取网页失败 {url}: {e}")
+            return None, None
+
+    async def fetch_to_part_async(self, session, url, part):
+        """
+        流式下载到.part文件, 与fetch_to_part相同, 只是传输使用aiohttp
+
+        Returns:
+            文件大小
+        """
+        offset, headers = self.range_request(part)
+        # 先等待令牌再占用并发名额, 等待令牌的请求不计入控制器的并发数
+        await self.image_limiter.acquire_async(url)
+        await self.controller.acquire_async()
+        latency = status = opened = None
+        written = 0
+        start = time.monotonic()
+        try:
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=60)) as response:
+                latency = time.monotonic() - start
+                status = response.status
+                if status != 416:
+                    response.raise_for_status()
+                opened = self.open_part(part, status, response.headers, offset)
+                if opened is not None:
+                    with open(part, 'ab' if opened[0] else 'wb') as f:
+                        async for chunk in response.content.iter_chunked(self.chunk_size):
+                            f.write(chunk)
+                            written += len(chunk)
+        finally:
+            self.controller.release(latency, status, written)
+            self.record_request(start, status, written)
+        if opened is None:
+            return await self.fetch_to_part_async(session, url, part)
+        offset, expected = opened
+        self.check_size(part, offset + written, expected)
+        return offset + written
+
+    async def download_image_async(self, session, url, index):
+        """
+        下载单张图片, 与download_image相同, 流式写入.part后改名, 中断时续传
+
+        Args:
+            session: aiohttp会话
+            url: 图片URL
+            index: 图片索引
+
+        Returns:
+            (成功状态, 文件名, 错误信息)
+        """
+        try:
+            filename = self.image_filename(url, index)
+            filepath = os.path.join(self.download_dir, filename)
+            image_hash = self.image_hash(url)
+
+            # 校验和在线程中计算, 不阻塞事件循环
+            if os.path.exists(filepath):
+                await asyncio.to_thread(self.record_existing, image_hash, url, filename, filepath)
+                return True, filename, None
+
+            logger.debug(f"正在下载图片 [{index}]: {filename}")
+            for attempt in range(1, self.retries + 1):
+                try:
+                    size = await self.fetch_to_part_async(session, url, filepath + '.part')
+                    break
+                except aiohttp.ClientResponseError as e:
+                    wait = self.retry_wait(attempt, filename, e, e.status, e.headers)
+                    if wait is None:
+                        raise
+                    await asyncio.sleep(wait)
+                except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+                    if self.retry_wait(attempt, filename, e) is None:
+                        raise
+            await asyncio.to_thread(self.finish_download, image_hash, url, filename, filepath, size)
+            return True, filename, None
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, IncompleteDownload) as e:
+            logger.error(f"图片下载失败 {url}: {e}")
+            self.record_failure(url, f"下载失败: {e}")
+            return False, None, f"下载失败: {e}"
+        except Exception as e:
+            logger.error(f"图片保存失败 {url}: {e}")
+            self.record_failure(url, f"保存失败: {e}")
+            return False, None, f"保存失败: {e}"
+
+    async def crawl_page(self, session, page):
+        """
+        获取一页并提取图片URL, 页面未修改时使用缓存的提取结果
+
+        Returns:
+            图片URL列表, 获取失败时返回None
+        """
+        url = self.page_url(page)
+        cached = self.page_cache.get(url)
+        html, validators = await self.request_page_async(session, url, cached)
+        if html is NOT_MODIFIED:
+            logger.debug(f"网页未修改，使用缓存: {url}")
+            return cached['urls']
+        if html is None:
+            return None
+        urls = await asyncio.to_thread(self.extract_image_urls, html, url)
+        self.page_cache.put(url, validators, urls)
+        return urls
+
+    async def run_async(self, full=False, metrics_port=None):
+        """
+        运行爬虫主流程
+
+        各页同时请求(增量运行时第1页有新图片后才请求其余页面), 按页码顺序处理结果, 某页获取失败时停止翻页(与同步版本一致)
+        每页的图片URL提取后立即开始下载, 不等待其余页面
+        索引中已下载的图片跳过, 某页的图片全部已下载时停止翻页
+
+        Args:
+            full: 为True时不因整页已下载而提前停止翻页
+            metrics_port: 提供Prometheus格式指标的本机端口, 默认不提供
+
+        Returns:
+            (成功数, 失败数)
+        """
+        logger.info("=" * 50)
+        logger.info("开始执行爬虫任务(异步)")
+        logger.info(f"目标URL: {self.base_url}")
+        logger.info(f"下载目录: {self.download_dir}")
+        logger.info(f"最大翻页数: {self.max_pages}")
+        logger.info("=" * 50)
+
+        reporter = Reporter(self.metrics, self.report_interval).start()
+        server = serve_metrics(self.metrics, metrics_port) if metrics_port is not None else None
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        seen = set()
+        known_count = 0
+        downloads = []
+        connector = aiohttp.TCPConnector(limit_per_host=self.concurrency + 1)
+        async with aiohttp.ClientSession(headers=dict(self.session.headers), connector=connector) as session:
+            pages = []
+
+            def prefetch(last):
+                for page in range(len(pages) + 1, min(last, self.max_pages) + 1):
+                    pages.append(asyncio.create_task(self.crawl_page(session, page)))
+
+            for page in range(1, self.max_pages + 1):
+                # 增量运行时先单独获取第1页, 有新图片时再同时请求后续页面
+                prefetch(self.max_pages if full or page > 1 else 1)
+                page_urls = await pages[page - 1]
+                if page_urls is None:
+                    logger.error(f"第 {page} 页获取失败，停止翻页")
+                    for rest in pages[page:]:
+                        rest.cancel()
+                    break
+                valid = []
+                for url in page_urls:
+                    processed_url = self.validate_and_process_url(url)
+                    if processed_url and processed_url not in seen:
+                        seen.add(processed_url)
+                        valid.append(processed_url)
+                new_urls, known = self.filter_known(self.page_url(page), valid)
+                known_count += known
+                self.metrics.inc('images_total', known, result='skipped')
+                for index, url in enumerate(valid, len(seen) - len(valid) + 1):
+                    if url in new_urls:
+                        downloads.append(asyncio.create_task(self.download_image_async(session, url, index)))
+                logger.debug(f"第 {page} 页提取到 {len(page_urls)} 个图片URL，已下载 {known} 个，累计有效 {len(seen)} 个")
+                if valid and not new_urls and not full:
+                    logger.info(f"第 {page} 页的图片均已下载，停止翻页")
+                    for rest in pages[page:]:
+                        rest.cancel()
+                    break
+
+            results = await asyncio.gather(*downloads, return_exceptions=True)
+
+        await asyncio.to_thread(self.finish_postprocess)
+        reporter.stop()
+        if server is not None:
+            server.shutdown()
+
+        success_count = sum(1 for r in results if not isinstance(r, BaseException) and r[0])
+        failed_count = len(results) - success_count
+
+        logger.info("=" * 50)
+        logger.info("任务完成统计:")
+        logger.info(f"总图片数: {len(seen)}")
+        logger.info(f"此前已下载: {known_count}")
+        logger.info(f"成功下载: {success_count}")
+        logger.info(f"失败下载: {failed_count}")
+        logger.info(f"下载并发数: 最终 {self.controller.limit}，最高 {max(self.controller.history)}")
+        logger.info(self.metrics.summary())
+        logger.info(f"下载目录: {self.download_dir}")
+        logger.info("=" * 50)
+        return success_count, failed_count
+
+    def run(self, max_workers=None, full=False, adaptive=True, metrics_port=None, postprocess=True):
+        """
+        同步入口
+
+        Args:
+            max_workers: 同时进行的请求数上限, 默认为concurrency
+            full: 为True时不因整页已下载而提前停止翻页
+            adaptive: 是否根据延迟、限流与吞吐量自动调整图片下载的并发数
+            metrics_port: 提供Prometheus格式指标的本机端口, 默认不提供
+            postprocess: 是否在进程池中检查下载的图片, 标记无效与重复的图片
+        """
+        if max_workers:
+            self.concurrency = max_workers
+        self.configure_concurrency(self.concurrency, adaptive)
+        self.start_postprocess(postprocess)
+        return asyncio.run(self.run_async(full, metrics_port))
+
+
+def main():
+    """
+    主函数
+    """
+    base_url = "https://www.bizhi99.com/2560x1600"
+    download_dir = "E:\\just-ads\\Pictures"
+    max_pages = 20
+
+    spider = AsyncBizhiSpider(base_url, download_dir, max_pages, rate=2, burst=2)
+    spider.run()
+
+
+if __name__ == "__main__":
+    main()
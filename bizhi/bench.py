@@ -0,0 +1,412 @@
+"""
+爬虫的离线基准测试
+
+在子进程中启动模仿网站的本地服务器: 列表页与网站结构相同(.item下的img[data-original]), 图片地址为imageMogr2格式,
+可设置延迟、错误率、并发上限与图片大小. 然后完整运行爬虫, 输出页/秒、图片/秒、MB/秒与内存(RSS)峰值
+
+python bench.py --pages 20 --per-page 40 --latency 0.05 --error-rate 0.01
+python bench.py --engine sync,async --workers 4,16 --capacity 8
+python bench.py --engine frontier --categories 3
+"""
+import sys
+import time
+import json
+import random
+import socket
+import shutil
+import asyncio
+import hashlib
+import logging
+import argparse
+import tempfile
+import contextlib
+import threading
+import multiprocessing
+from io import BytesIO
+
+from aiohttp import web
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from spider import BizhiSpider
+
+DEFAULTS = {
+    'pages': 10,
+    'per_page': 40,
+    # 每个请求的平均延迟(秒), 实际在0.5到1.5倍之间随机
+    'latency': 0.02,
+    # 返回500的请求比例
+    'error_rate': 0,
+    # 同时处理的图片请求数上限, 超过时返回429, 0表示不限
+    'capacity': 0,
+    'image_min': 200 * 1024,
+    'image_max': 800 * 1024,
+    # 与其他图片画面相同(哈希不同)的图片比例
+    'duplicate_rate': 0,
+}
+
+
+# 第一个分类, 单列表的爬虫只爬取该分类
+CATEGORY = '2560x1600'
+
+
+def image_hash(page, index, category=CATEGORY):
+    key = f'{page}-{index}' if category == CATEGORY else f'{category}-{page}-{index}'
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def picture(seed):
+    """
+    由种子确定的小JPEG画面: 随机位置与颜色的矩形
+    """
+    rng = random.Random(seed)
+    image = Image.new('RGB', (320, 200), tuple(rng.randrange(256) for _ in range(3)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(300), rng.randrange(180)
+        draw.rectangle((x, y, x + rng.randint(20, 160), y + rng.randint(20, 120)),
+                       fill=tuple(rng.randrange(256) for _ in range(3)))
+    buffer = BytesIO()
+    image.save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+def image_body(digest, config):
+    """
+    由哈希确定的图片内容, 同一张图片每次请求内容相同
+
+    安装了Pillow时为有效的JPEG, 其后填充随机字节到设定的大小; duplicate_rate比例的图片使用共同的几个画面
+    """
+    rng = random.Random(digest)
+    size = rng.randint(config['image_min'], config['image_max'])
+    if Image is None:
+        return rng.randbytes(size)
+    seed = f'shared-{rng.randrange(4)}' if rng.random() < config['duplicate_rate'] else digest
+    body = picture(seed)
+    return body + rng.randbytes(max(size - len(body), 0))
+
+
+def listing_page(page, host, config, category=CATEGORY):
+    items = []
+    for i in range(config['per_page']):
+        # 其他分类的列表中有一部分是第一个分类的图片
+        shared = category != CATEGORY and i % 4 == 0
+        digest = image_hash(page, i) if shared else image_hash(page, i, category)
+        items.append(
+            f'<li class="item"><a href="/desk/{digest}.html" title="壁纸 {page}-{i}">'
+            f'<img class="lazy" src="/static/loading.gif" '
+            f'data-original="{host}/pic/{digest}?imageMogr2/thumbnail/x380/quality/90!" alt="壁纸"></a>'
+            f'<p>2560x1600</p></li>')
+    nav = ''.join(f'<a href="/{category}/{p}.html">{p}</a>' for p in range(1, config['pages'] + 1))
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>壁纸 第{page}页</title></head>'
+            f'<body><div class="nav">{nav}</div><ul class="list">{"".join(items)}</ul></body></html>')
+
+
+def make_app(config, host):
+    """
+    模仿网站的aiohttp应用
+
+    Args:
+        config: 服务器参数, 见DEFAULTS
+        host: 列表页中图片的主机
+    """
+    state = {'in_flight': 0}
+
+    async def delay():
+        if config['latency']:
+            await asyncio.sleep(config['latency'] * random.uniform(0.5, 1.5))
+
+    def failed():
+        return random.random() < config['error_rate']
+
+    async def page(request):
+        number = int(request.match_info['page'])
+        if number > config['pages']:
+            raise web.HTTPNotFound()
+        await delay()
+        if failed():
+            raise web.HTTPInternalServerError()
+        html = listing_page(number, host, config, request.match_info['category'])
+        # 与网站一样带ETag, 支持条件请求
+        etag = '"' + hashlib.md5(html.encode()).hexdigest() + '"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=html, content_type='text/html', charset='utf-8', headers={'ETag': etag})
+
+    async def image(request):
+        if config['capacity'] and state['in_flight'] >= config['capacity']:
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        state['in_flight'] += 1
+        try:
+            await delay()
+            if failed():
+                raise web.HTTPInternalServerError()
+            body = image_body(request.match_info['hash'], config)
+            # 支持续传的Range请求
+            match = request.http_range
+            if match.start:
+                if match.start >= len(body):
+                    raise web.HTTPRequestRangeNotSatisfiable()
+                return web.Response(status=206, body=body[match.start:], content_type='image/jpeg', headers={
+                    'Content-Range': f'bytes {match.start}-{len(body) - 1}/{len(body)}'})
+            return web.Response(body=body, content_type='image/jpeg')
+        finally:
+            state['in_flight'] -= 1
+
+    app = web.Application()
+    app.router.add_get('/{category}/{page}.html', page)
+    app.router.add_get('/pic/{hash}', image)
+    return app
+
+
+def serve(port, config, ready):
+    """
+    子进程中运行服务器
+    """
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+
+    async def main():
+        runner = web.AppRunner(make_app(config, f'http://127.0.0.1:{port}'))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class StandIn:
+    """
+    在子进程中运行的本地网站, 用作上下文管理器
+    """
+
+    def __init__(self, **config):
+        self.config = {**DEFAULTS, **config}
+        self.port = free_port()
+        self.host = f'http://127.0.0.1:{self.port}'
+        self.base_url = f'{self.host}/{CATEGORY}'
+
+    def seeds(self, count):
+        """
+        Returns:
+            count个分类的列表URL, 第一个为base_url
+        """
+        return [self.base_url] + [f'{self.host}/category{i}' for i in range(1, count)]
+
+    def __enter__(self):
+        ready = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=serve, args=(self.port, self.config, ready), daemon=True)
+        self.process.start()
+        if not ready.wait(30):
+            raise RuntimeError('本地服务器启动失败')
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+
+def rss(exclude=()):
+    """
+    本进程及子进程(检查进程池等)的内存占用(RSS)
+
+    Args:
+        exclude: 不计入的子进程pid, 如本地网站
+
+    Returns:
+        字节数, 没有安装psutil时返回None
+    """
+    if psutil is None:
+        return None
+    process = psutil.Process()
+    total = process.memory_info().rss
+    skipped = set(exclude)
+    for child in process.children(recursive=True):
+        try:
+            if child.pid in skipped or child.ppid() in skipped:
+                skipped.add(child.pid)
+                continue
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+class PeakMemory:
+    """
+    运行期间定时采样内存占用, 记录峰值, 用作上下文管理器
+
+    有psutil时为本进程与子进程RSS之和的峰值, 包括套接字缓冲、Pillow与检查进程池等tracemalloc看不到的内存;
+    没有时以getrusage的ru_maxrss代替, 为本进程与已结束子进程各自历史峰值之和, 多次运行时只增不减
+    """
+
+    def __init__(self, exclude=(), interval=0.05):
+        """
+        Args:
+            exclude: 不计入的子进程pid
+            interval: 采样间隔(秒)
+        """
+        self.exclude = exclude
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+
+    def sample(self):
+        value = rss(self.exclude)
+        if value is not None:
+            self.peak = max(self.peak or 0, value)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        if psutil is not None:
+            self.sample()
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if psutil is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.sample()
+        elif resource is not None:
+            # Linux为KB, macOS为字节
+            scale = 1 if sys.platform == 'darwin' else 1024
+            self.peak = sum(resource.getrusage(who).ru_maxrss
+                            for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) * scale
+
+
+def run(site, engine='sync', max_workers=16, adaptive=True, rate=1000, burst=100, extractor=None,
+        measure_memory=True, postprocess=True, categories=1, image_rate=None):
+    """
+    完整运行一次爬虫
+
+    Args:
+        site: StandIn
+        engine: sync为BizhiSpider, async为AsyncBizhiSpider, frontier为同时爬取categories个分类的FrontierSpider
+        max_workers: 最大并发下载数
+        adaptive: 是否自动调整并发数
+        rate: 列表页每秒的请求数
+        burst: 列表页允许的瞬时突发请求数
+        extractor: 图片地址的提取后端, 默认为爬虫的默认值
+        measure_memory: 是否统计内存(RSS)峰值, 不计入本地网站的进程
+        postprocess: 是否检查下载的图片
+        categories: frontier爬取的分类数
+        image_rate: 图片每秒的请求数, 默认不限
+
+    Returns:
+        结果dict
+    """
+    directory = tempfile.mkdtemp(prefix='bizhi-bench-')
+    kwargs = {'image_host': site.host, 'image_rate': image_rate}
+    if extractor:
+        kwargs['extractor'] = extractor
+    try:
+        if engine == 'async':
+            from async_spider import AsyncBizhiSpider
+            spider = AsyncBizhiSpider(site.base_url, directory, site.config['pages'], rate, burst,
+                                      concurrency=max_workers, **kwargs)
+        elif engine == 'frontier':
+            from frontier import FrontierSpider
+            spider = FrontierSpider(site.seeds(categories), directory, site.config['pages'], rate, burst, **kwargs)
+        else:
+            spider = BizhiSpider(site.base_url, directory, site.config['pages'], rate, burst, **kwargs)
+        spider.report_interval = 3600
+        memory = PeakMemory(exclude=[site.process.pid]) if measure_memory else None
+        start = time.perf_counter()
+        with memory or contextlib.nullcontext():
+            spider.run(max_workers=max_workers, adaptive=adaptive, postprocess=postprocess)
+        elapsed = time.perf_counter() - start
+        peak = memory.peak if memory else None
+        spider.index.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    metrics = spider.metrics
+    downloaded = metrics.counter('images_total', result='downloaded')
+    size = metrics.counter('download_bytes_total')
+    return {
+        'engine': engine,
+        'workers': max_workers,
+        'adaptive': adaptive,
+        'seconds': elapsed,
+        'pages': metrics.counter('pages_total'),
+        'images': downloaded,
+        'failed': metrics.counter('images_total', result='failed'),
+        'pages_per_s': metrics.counter('pages_total') / elapsed,
+        'images_per_s': downloaded / elapsed,
+        'mb_per_s': size / elapsed / 1024 / 1024,
+        'peak_mb': peak / 1024 / 1024 if peak is not None else None,
+        'concurrency': max(spider.controller.history),
+        'duplicates': metrics.counter('postprocess_total', result='duplicate'),
+        'invalid': metrics.counter('postprocess_total', result='invalid'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='爬虫离线基准测试')
+    parser.add_argument('--pages', type=int, default=DEFAULTS['pages'])
+    parser.add_argument('--per-page', type=int, default=DEFAULTS['per_page'])
+    parser.add_argument('--latency', type=float, default=DEFAULTS['latency'], help='平均请求延迟(秒)')
+    parser.add_argument('--error-rate', type=float, default=DEFAULTS['error_rate'], help='返回500的比例')
+    parser.add_argument('--capacity', type=int, default=DEFAULTS['capacity'], help='图片并发上限, 超过时返回429')
+    parser.add_argument('--image-kb', default='200-800', help='图片大小范围(KB)')
+    parser.add_argument('--duplicate-rate', type=float, default=DEFAULTS['duplicate_rate'], help='画面重复的图片比例')
+    parser.add_argument('--engine', default='sync', help='逗号分隔: sync, async, frontier')
+    parser.add_argument('--categories', type=int, default=1, help='frontier同时爬取的分类数')
+    parser.add_argument('--workers', default='16', help='逗号分隔的最大并发下载数')
+    parser.add_argument('--fixed', action='store_true', help='固定并发数, 不自动调整')
+    parser.add_argument('--rate', type=float, default=1000, help='列表页每秒的请求数')
+    parser.add_argument('--image-rate', type=float, default=None, help='图片每秒的请求数, 默认不限')
+    parser.add_argument('--extractor', default=None)
+    parser.add_argument('--no-memory', action='store_true', help='不统计内存峰值')
+    parser.add_argument('--no-postprocess', action='store_true', help='不检查下载的图片')
+    parser.add_argument('--json', help='结果写入的文件')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    image_min, image_max = (int(v) * 1024 for v in args.image_kb.split('-'))
+    results = []
+    with StandIn(pages=args.pages, per_page=args.per_page, latency=args.latency, error_rate=args.error_rate,
+                 capacity=args.capacity, image_min=image_min, image_max=image_max,
+                 duplicate_rate=args.duplicate_rate) as site:
+        for engine in args.engine.split(','):
+            for workers in args.workers.split(','):
+                result = run(site, engine, int(workers), not args.fixed, args.rate, extractor=args.extractor,
+                             measure_memory=not args.no_memory, postprocess=not args.no_postprocess,
+                             categories=args.categories, image_rate=args.image_rate)
+                results.append(result)
+                peak = f"{result['peak_mb']:7.1f} MB" if result['peak_mb'] is not None else '      -'
+                print(f"{engine:8s} 并发{workers:>3s}  {result['seconds']:6.2f}s  "
+                      f"{result['pages_per_s']:6.1f} 页/s  {result['images_per_s']:7.1f} 图/s  "
+                      f"{result['mb_per_s']:7.1f} MB/s  峰值{peak}  "
+                      f"失败{result['failed']}  重复{result['duplicates']}  最高并发{result['concurrency']}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
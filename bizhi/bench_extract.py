@@ -0,0 +1,106 @@
+"""
+图片地址提取后端的基准测试
+
+在保存的列表页上比较各后端的解析耗时, 并检查提取的URL集合与bs4是否一致
+
+python bench_extract.py pages --save 5   # 先从网站保存5个列表页
+python bench_extract.py pages
+"""
+import os
+import glob
+import time
+import argparse
+from urllib.parse import urljoin
+
+import extract
+from spider import BizhiSpider
+
+
+def save_pages(base_url, directory, count):
+    """
+    保存列表页
+
+    Args:
+        base_url: 目标网页URL
+        directory: 保存目录
+        count: 页数
+    """
+    os.makedirs(directory, exist_ok=True)
+    spider = BizhiSpider(base_url, directory, count, index_path=':memory:',
+                         cache_path=':memory:')
+    for page in range(1, count + 1):
+        html = spider.fetch_page(f'{base_url}/{page}.html')
+        if html is None:
+            break
+        with open(os.path.join(directory, f'{page}.html'), 'w', encoding='utf-8') as f:
+            f.write(html)
+
+
+def load_pages(directory):
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(directory, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            pages[os.path.basename(path)] = f.read()
+    return pages
+
+
+def run(pages, base_url, backends, repeat=5):
+    """
+    Args:
+        pages: {文件名: 网页内容}
+        base_url: 解析相对地址的基准URL
+        backends: 后端名称列表
+        repeat: 重复次数, 取最快一次
+
+    Returns:
+        {后端: {'ms_per_page', 'speedup', 'mismatches'}}, speedup相对于bs4
+    """
+    expected = {name: {urljoin(base_url, src) for src in extract.extract_bs4(html)[1]}
+                for name, html in pages.items()}
+    results = {}
+    for backend in backends:
+        func = extract.EXTRACTORS[backend]
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for html in pages.values():
+                func(html)
+            best = min(best, time.perf_counter() - start)
+        mismatches = [name for name, html in pages.items()
+                      if {urljoin(base_url, src) for src in func(html)[1]} != expected[name]]
+        results[backend] = {'ms_per_page': best / len(pages) * 1000, 'mismatches': mismatches}
+    if 'bs4' in results:
+        for result in results.values():
+            result['speedup'] = results['bs4']['ms_per_page'] / result['ms_per_page']
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='图片地址提取后端基准测试')
+    parser.add_argument('directory', help='保存的列表页(*.html)所在目录')
+    parser.add_argument('--base-url', default='https://www.bizhi99.com/2560x1600')
+    parser.add_argument('--save', type=int, default=0, help='先从网站保存的列表页数')
+    parser.add_argument('--backends', default=','.join(extract.available()), help='逗号分隔的后端')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.save:
+        save_pages(args.base_url, args.directory, args.save)
+    pages = load_pages(args.directory)
+    if not pages:
+        parser.error(f'{args.directory}中没有列表页')
+
+    size = sum(len(html) for html in pages.values())
+    print(f'{len(pages)} 页, 平均 {size / len(pages) / 1024:.1f} KB')
+    results = run(pages, args.base_url, args.backends.split(','), args.repeat)
+    for backend, result in results.items():
+        line = f"{backend:8s} {result['ms_per_page']:8.2f} ms/页"
+        if 'speedup' in result:
+            line += f"  {result['speedup']:5.1f}x"
+        if result['mismatches']:
+            line += f"  与bs4不一致: {', '.join(result['mismatches'])}"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+列表页图片地址的提取
+
+各后端提取class含item的元素下所有img标签的data-original(为空时取src)属性, 结果与BeautifulSoup一致:
+    bs4: BeautifulSoup(html.parser)建树后查找, 最慢, 作为基准
+    stream: 基于标准库HTMLParser的流式提取, 不建树, 只跟踪打开的标签, 标签的开闭规则与bs4的html.parser相同
+    lxml: lxml解析后以XPath查找, 需要安装lxml. 其容错规则与html.parser不同, 标签不规范的页面上结果可能不一致
+          (如未闭合的<li>、<p>内的<div>), 因此只在明确指定时使用
+"""
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+
+# bs4的html.parser不压栈的空元素
+VOID_ELEMENTS = {
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'command', 'embed', 'frame', 'hr', 'image', 'img',
+    'input', 'isindex', 'keygen', 'link', 'menuitem', 'meta', 'nextid', 'param', 'source', 'spacer', 'track', 'wbr',
+}
+
+
+def image_src(attrs):
+    # 优先使用data-original属性，如果没有则使用src
+    return attrs.get('data-original') or attrs.get('src')
+
+
+def extract_bs4(html):
+    """
+    Args:
+        html: 网页内容
+
+    Returns:
+        (item元素数, 图片地址列表)
+    """
+    soup = BeautifulSoup(html, 'html.parser')
+    items = soup.find_all(class_='item')
+    srcs = []
+    for item in items:
+        for img in item.find_all('img'):
+            src = image_src(img)
+            if src:
+                srcs.append(src)
+    return len(items), srcs
+
+
+class ItemImageParser(HTMLParser):
+    """
+    流式提取item元素内的img属性
+
+    与bs4一样, 结束标签关闭最近的同名标签及其内未关闭的标签, 没有对应开始标签的结束标签忽略
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        # 打开的标签及其是否为item
+        self.stack = []
+        self.depth = 0
+        self.items = 0
+        self.srcs = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        is_item = 'item' in (attrs.get('class') or '').split()
+        self.items += is_item
+        if tag == 'img' and self.depth:
+            src = image_src(attrs)
+            if src:
+                self.srcs.append(src)
+        if tag not in VOID_ELEMENTS:
+            self.stack.append((tag, is_item))
+            self.depth += is_item
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                self.depth -= sum(is_item for _, is_item in self.stack[i:])
+                del self.stack[i:]
+                return
+
+
+def extract_stream(html):
+    parser = ItemImageParser()
+    parser.feed(html)
+    parser.close()
+    return parser.items, parser.srcs
+
+
+def extract_lxml(html):
+    if lxml is None:
+        raise ImportError('需要安装lxml')
+    if not html.strip():
+        return 0, []
+    root = lxml.html.fromstring(html)
+    items = root.xpath("//*[contains(concat(' ', normalize-space(@class), ' '), ' item ')]")
+    srcs = []
+    for item in items:
+        for img in item.iter('img'):
+            if img is item:
+                continue
+            src = image_src(img.attrib)
+            if src:
+                srcs.append(src)
+    return len(items), srcs
+
+
+EXTRACTORS = {
+    'bs4': extract_bs4,
+    'stream': extract_stream,
+    'lxml': extract_lxml,
+}
+
+# 默认使用与bs4结果一致的最快后端, lxml需明确指定
+DEFAULT_EXTRACTOR = 'stream'
+
+
+def available():
+    """
+    Returns:
+        可用的后端名称列表
+    """
+    return [name for name in EXTRACTORS if name != 'lxml' or lxml is not None]
@@ -0,0 +1,278 @@
+"""
+多个列表的爬取调度
+
+一个进程同时爬取多个分辨率或分类的列表, 共用HTTP会话与连接池、按主机的令牌桶、图片索引与下载并发控制器,
+同一张图片出现在多个列表中时只下载一次
+
+python frontier.py https://www.bizhi99.com/2560x1600 https://www.bizhi99.com/1920x1080
+"""
+import heapq
+import logging
+import argparse
+import itertools
+import threading
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from spider import BizhiSpider
+from extract import DEFAULT_EXTRACTOR
+from metrics import Reporter, serve as serve_metrics
+
+logger = logging.getLogger(__name__)
+
+PAGE = 'page'
+IMAGE = 'image'
+# 同一主机上页面先于图片: 页面带来新的任务, 且请求很小
+KIND_RANK = {PAGE: 0, IMAGE: 1}
+
+# priority为页码, 越小越优先, 即各列表较新的页面与其中的图片先爬取; index为图片序号, 页面为None
+Task = namedtuple('Task', 'kind url priority seed index')
+
+
+class Frontier:
+    """
+    待爬取的页面与图片, 按(主机, 类型)分队, 每个队列按优先级排序
+
+    next在令牌桶已有令牌的主机中选出优先级最高的任务, 不让一个主机的限速阻塞其他主机的任务;
+    图片下载达到并发上限时只分派页面, 待下载的图片达到queue_size时暂停分派页面
+    令牌仍由请求时的limiter.acquire消耗, 这里只查询, 多个线程同时选中同一主机时后者短暂等待
+    """
+
+    def __init__(self, limiters, controller, queue_size=100):
+        """
+        Args:
+            limiters: {任务类型: RateLimiter}, 页面与图片分别限速
+            controller: AIMDController
+            queue_size: 待下载图片数上限
+        """
+        self.limiters = limiters
+        self.controller = controller
+        self.queue_size = queue_size
+        self.queues = {}
+        self.images = 0
+        self.active = 0
+        self.closed = False
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+
+    def push(self, task):
+        with self.condition:
+            key = (urlparse(task.url).netloc, task.kind)
+            heapq.heappush(self.queues.setdefault(key, []), (task.priority, next(self.order), task))
+            if task.kind == IMAGE:
+                self.images += 1
+            self.condition.notify()
+
+    def pick(self):
+        """
+        选出可以立即开始的任务
+
+        Returns:
+            (队列键, 需要等待的秒数), 没有可调度的任务时为(None, None)
+        """
+        best = None
+        wait = None
+        controller_full = self.controller.at_limit()
+        for key, heap in self.queues.items():
+            host, kind = key
+            if not heap:
+                continue
+            if kind == IMAGE and controller_full or kind == PAGE and self.images >= self.queue_size:
+                continue
+            delay = self.limiters[kind].wait_time(heap[0][2].url)
+            if delay:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            rank = (KIND_RANK[kind], heap[0][0], heap[0][1])
+            if best is None or rank < best[0]:
+                best = (rank, key)
+        return (best[1] if best else None), wait
+
+    def next(self):
+        """
+        取出下一个任务, 没有可以开始的任务时等待
+
+        Returns:
+            Task, 所有任务完成或已关闭时返回None
+        """
+        with self.condition:
+            while not self.closed:
+                key, wait = self.pick()
+                if key is not None:
+                    task = heapq.heappop(self.queues[key])[2]
+                    if task.kind == IMAGE:
+                        self.images -= 1
+                    self.active += 1
+                    return task
+                if self.active == 0 and not any(self.queues.values()):
+                    break
+                # 下载重试期间控制器的名额变化不经过done, 没有令牌等待时间时也定期重新检查
+                self.condition.wait(min(wait, 0.1) if wait is not None else 0.1)
+            self.condition.notify_all()
+            return None
+
+    def done(self, task):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        丢弃尚未开始的任务, 正在执行的任务完成后next返回None
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class FrontierSpider(BizhiSpider):
+    """
+    从多个列表(种子)同时爬取的爬虫
+
+    各列表逐页翻页, 与BizhiSpider一样某页的图片全部已下载时停止该列表的翻页; 页面与图片由Frontier统一调度,
+    由同一组线程执行. 页面解析、URL处理与下载沿用BizhiSpider
+    """
+
+    def __init__(self, seeds, download_dir="E:\\just-ads\\Pictures", max_pages=21, rate=2, burst=2,
+                 index_path=None, extractor=DEFAULT_EXTRACTOR, image_host="https://pic.dmjnb.com", cache_path=None,
+                 image_rate=None, image_burst=None):
+        """
+        Args:
+            seeds: 列表URL的列表, 如https://www.bizhi99.com/2560x1600, 第n页为{seed}/{n}.html
+            download_dir: 图片下载目录, 所有列表共用
+            max_pages: 每个列表的最大翻页数
+            其余参数与BizhiSpider相同
+        """
+        super().__init__(seeds[0], download_dir, max_pages, rate, burst, index_path, extractor, image_host,
+                         cache_path, image_rate, image_burst)
+        self.seeds = list(dict.fromkeys(seed.rstrip('/') for seed in seeds))
+
+    def crawl_seed_page(self, frontier, task, state, full):
+        """
+        获取一个列表页, 新图片加入调度, 需要时调度该列表的下一页
+        """
+        page_urls = self.fetch_image_urls(task.url)
+        stats = state['seeds'][task.seed]
+        if page_urls is None:
+            logger.error(f"{task.seed} 第 {task.priority} 页获取失败，停止翻页")
+            return
+        valid = []
+        with state['lock']:
+            for url in page_urls:
+                processed_url = self.validate_and_process_url(url)
+                if processed_url and processed_url not in state['seen']:
+                    state['seen'].add(processed_url)
+                    valid.append(processed_url)
+        new_urls, known = self.filter_known(task.url, valid)
+        self.metrics.inc('images_total', known, result='skipped')
+        with state['lock']:
+            stats['pages'] += 1
+            stats['known'] += known
+            for url in valid:
+                if url in new_urls:
+                    state['index'] += 1
+                    frontier.push(Task(IMAGE, url, task.priority, task.seed, state['index']))
+        logger.debug(f"{task.seed} 第 {task.priority} 页提取到 {len(page_urls)} 个图片URL，"
+                     f"有效 {len(valid)} 个，已下载 {known} 个")
+        if valid and not new_urls and not full:
+            logger.info(f"{task.seed} 第 {task.priority} 页的图片均已下载，停止翻页")
+        elif task.priority < self.max_pages:
+            frontier.push(Task(PAGE, f'{task.seed}/{task.priority + 1}.html', task.priority + 1, task.seed, None))
+
+    def run(self, max_workers=16, queue_size=100, full=False, adaptive=True, metrics_port=None, postprocess=True):
+        """
+        运行爬虫主流程
+
+        Args:
+            max_workers: 最大并发下载数, adaptive为True时是自动调整的上限; 另有一个线程保证下载占满时仍能翻页
+            queue_size: 待下载图片数上限, 超过时暂停翻页
+            full: 为True时不因整页已下载而提前停止翻页
+            adaptive: 是否根据延迟、限流与吞吐量自动调整并发数
+            metrics_port: 提供Prometheus格式指标的本机端口, 默认不提供
+            postprocess: 是否在进程池中检查下载的图片, 标记无效与重复的图片
+        """
+        self.configure_concurrency(max_workers, adaptive)
+        self.start_postprocess(postprocess)
+        reporter = Reporter(self.metrics, self.report_interval).start()
+        server = serve_metrics(self.metrics, metrics_port) if metrics_port is not None else None
+        logger.info("=" * 50)
+        logger.info("开始执行爬虫任务(多列表)")
+        for seed in self.seeds:
+            logger.info(f"目标URL: {seed}")
+        logger.info(f"下载目录: {self.download_dir}")
+        logger.info(f"每个列表最大翻页数: {self.max_pages}")
+        logger.info("=" * 50)
+
+        frontier = Frontier({PAGE: self.limiter, IMAGE: self.image_limiter}, self.controller, queue_size)
+        state = {
+            'lock': threading.Lock(),
+            'seen': set(),
+            'index': 0,
+            'seeds': {seed: {'pages': 0, 'known': 0, 'success': 0, 'failed': 0} for seed in self.seeds},
+        }
+        for seed in self.seeds:
+            frontier.push(Task(PAGE, f'{seed}/1.html', 1, seed, None))
+
+        def worker():
+            while True:
+                task = frontier.next()
+                if task is None:
+                    break
+                success = False
+                try:
+                    if task.kind == PAGE:
+                        self.crawl_seed_page(frontier, task, state, full)
+                    else:
+                        success, filename, error = self.download_image(task.url, task.index, None)
+                        if not success:
+                            logger.error(f"下载失败: {task.url} - {error}")
+                except Exception as e:
+                    logger.error(f"任务执行异常 {task.url}: {e}")
+                finally:
+                    if task.kind == IMAGE:
+                        with state['lock']:
+                            state['seeds'][task.seed]['success' if success else 'failed'] += 1
+                    frontier.done(task)
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(max_workers + 1)]
+        for t in workers:
+            t.start()
+        try:
+            for t in workers:
+                t.join()
+        finally:
+            frontier.close()
+            for t in workers:
+                t.join()
+            self.finish_postprocess()
+            reporter.stop()
+            if server is not None:
+                server.shutdown()
+
+        logger.info("=" * 50)
+        logger.info("任务完成统计:")
+        for seed, stats in state['seeds'].items():
+            logger.info(f"{seed}: 页面 {stats['pages']}，此前已下载 {stats['known']}，"
+                        f"成功下载 {stats['success']}，失败下载 {stats['failed']}")
+        logger.info(f"总图片数: {len(state['seen'])}")
+        logger.info(f"下载并发数: 最终 {self.controller.limit}，最高 {max(self.controller.history)}")
+        logger.info(self.metrics.summary())
+        logger.info(f"下载目录: {self.download_dir}")
+        logger.info("=" * 50)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='同时爬取多个列表')
+    parser.add_argument('seeds', nargs='+', help='列表URL, 如https://www.bizhi99.com/2560x1600')
+    parser.add_argument('--dir', default="E:\\just-ads\\Pictures", help='图片下载目录')
+    parser.add_argument('--pages', type=int, default=20, help='每个列表的最大翻页数')
+    parser.add_argument('--workers', type=int, default=16, help='最大并发下载数')
+    parser.add_argument('--full', action='store_true', help='不因整页已下载而提前停止翻页')
+    args = parser.parse_args()
+
+    spider = FrontierSpider(args.seeds, args.dir, args.pages)
+    spider.run(max_workers=args.workers, full=args.full)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+import json
+import time
+import sqlite3
+import threading
+
+# 条件请求返回304时request_page返回的内容
+NOT_MODIFIED = object()
+
+
+def conditional_headers(entry):
+    """
+    由缓存条目生成条件请求头
+
+    Args:
+        entry: PageCache.get的返回值, 可以为None
+
+    Returns:
+        请求头dict
+    """
+    headers = {}
+    if entry:
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+class PageCache:
+    """
+    列表页的HTTP缓存(SQLite), 保存每页的ETag、Last-Modified与提取出的图片URL
+
+    页面未修改(304)时直接使用缓存的URL, 不再下载与解析. 多线程共用一个连接, 以锁串行访问
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: 数据库文件路径
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                urls TEXT,
+                updated REAL
+            )
+        ''')
+        self.db.commit()
+
+    def get(self, url):
+        """
+        Returns:
+            {'etag', 'last_modified', 'urls'}, 不存在时返回None
+        """
+        with self.lock:
+            row = self.db.execute('SELECT etag, last_modified, urls FROM pages WHERE url=?', (url,)).fetchone()
+        if row is None:
+            return None
+        return {'etag': row[0], 'last_modified': row[1], 'urls': json.loads(row[2])}
+
+    def put(self, url, validators, urls):
+        """
+        Args:
+            url: 页面URL
+            validators: (ETag, Last-Modified), 都为空时服务器不支持条件请求, 不缓存
+            urls: 页面中的图片URL列表
+        """
+        etag, last_modified = validators
+        with self.lock:
+            if etag or last_modified:
+                self.db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)',
+                                (url, etag, last_modified, json.dumps(urls), time.time()))
+            else:
+                self.db.execute('DELETE FROM pages WHERE url=?', (url,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
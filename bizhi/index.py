@@ -0,0 +1,190 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    """
+    计算文件的sha256
+
+    Args:
+        path: 文件路径
+        chunk_size: 每次读取的字节数
+
+    Returns:
+        十六进制字符串
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class ImageIndex:
+    """
+    已发现图片的持久化索引(SQLite), 以URL中32位十六进制的图片哈希为键
+
+    记录图片的URL、发现的页面URL、状态、大小与校验和, 以及下载后检查得到的格式、尺寸与感知哈希
+    多线程共用一个连接, 以锁串行访问
+    状态: pending已发现未下载, done已下载, failed下载失败, invalid不是有效的图片, duplicate与已有图片重复
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: 数据库文件路径
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS images (
+                hash TEXT PRIMARY KEY,
+                url TEXT,
+                page TEXT,
+                status TEXT,
+                filename TEXT,
+                size INTEGER,
+                checksum TEXT,
+                error TEXT,
+                first_seen REAL,
+                updated REAL,
+                format TEXT,
+                width INTEGER,
+                height INTEGER,
+                phash TEXT,
+                duplicate_of TEXT
+            )
+        ''')
+        self.db.commit()
+
+    def known(self, hashes):
+        """
+        已下载的图片哈希
+
+        Args:
+            hashes: 图片哈希列表
+
+        Returns:
+            其中状态为done或duplicate的哈希集合, 重复的图片也不再下载
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return set()
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT hash FROM images WHERE status IN ('done', 'duplicate') "
+                f"AND hash IN ({','.join('?' * len(hashes))})", hashes).fetchall()
+        return {row[0] for row in rows}
+
+    def invalid(self, hashes):
+        """
+        检查为无效的图片
+
+        Args:
+            hashes: 图片哈希列表
+
+        Returns:
+            {图片哈希: (文件名, 大小)}, 只包含状态为invalid的
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return {}
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT hash, filename, size FROM images WHERE status='invalid' "
+                f"AND hash IN ({','.join('?' * len(hashes))})", hashes).fetchall()
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def get(self, image_hash):
+        """
+        Returns:
+            记录的dict, 不存在时返回None
+        """
+        with self.lock:
+            cursor = self.db.execute('SELECT * FROM images WHERE hash=?', (image_hash,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([c[0] for c in cursor.description], row))
+
+    def add(self, page, items):
+        """
+        记录一页中新发现的图片, 已存在的不变
+
+        Args:
+            page: 发现图片的页面URL, 多个列表同时爬取时页码不能区分来源
+            items: (图片哈希, URL)列表
+        """
+        now = time.time()
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO images (hash, url, page, status, first_seen, updated) "
+                                "VALUES (?, ?, ?, 'pending', ?, ?)",
+                                [(image_hash, url, page, now, now) for image_hash, url in items])
+            self.db.commit()
+
+    def mark_done(self, image_hash, url, filename, size, checksum):
+        with self.lock:
+            now = time.time()
+            self.db.execute("INSERT OR IGNORE INTO images (hash, url, first_seen) VALUES (?, ?, ?)",
+                            (image_hash, url, now))
+            self.db.execute("UPDATE images SET status='done', filename=?, size=?, checksum=?, error=NULL, "
+                            "updated=? WHERE hash=?", (filename, size, checksum, now, image_hash))
+            self.db.commit()
+
+    def mark_failed(self, image_hash, url, error):
+        with self.lock:
+            now = time.time()
+            self.db.execute("INSERT OR IGNORE INTO images (hash, url, first_seen) VALUES (?, ?, ?)",
+                            (image_hash, url, now))
+            self.db.execute("UPDATE images SET status='failed', error=?, updated=? WHERE hash=?",
+                            (error, now, image_hash))
+            self.db.commit()
+
+    def mark_inspected(self, image_hash, format, width, height, phash):
+        with self.lock:
+            self.db.execute('UPDATE images SET format=?, width=?, height=?, phash=?, updated=? WHERE hash=?',
+                            (format, width, height, phash, time.time(), image_hash))
+            self.db.commit()
+
+    def mark_invalid(self, image_hash, error):
+        with self.lock:
+            self.db.execute("UPDATE images SET status='invalid', error=?, updated=? WHERE hash=?",
+                            (error, time.time(), image_hash))
+            self.db.commit()
+
+    def mark_duplicate(self, image_hash, original):
+        with self.lock:
+            self.db.execute("UPDATE images SET status='duplicate', duplicate_of=?, updated=? WHERE hash=?",
+                            (original, time.time(), image_hash))
+            self.db.commit()
+
+    def phashes(self):
+        """
+        Returns:
+            已下载图片的[(感知哈希, 图片哈希)], 感知哈希为int
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT phash, hash FROM images WHERE status='done' AND phash IS NOT NULL").fetchall()
+        return [(int(phash, 16), image_hash) for phash, image_hash in rows]
+
+    def counts(self):
+        """
+        Returns:
+            {状态: 数量}
+        """
+        with self.lock:
+            return dict(self.db.execute('SELECT status, COUNT(*) FROM images GROUP BY status').fetchall())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
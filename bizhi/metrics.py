@@ -0,0 +1,214 @@
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# 延迟直方图的默认分桶(秒)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """
+    累积分桶的直方图, 与Prometheus的histogram相同
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        由分桶估计分位数, 桶内按线性插值
+
+        Returns:
+            估计值, 没有数据时返回None
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                lower = self.buckets[i - 1] if i else 0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    """
+    计数器、数值与直方图, 可多线程访问
+
+    按名称与标签区分, 如inc('requests_total', kind='image', status=200)
+    """
+
+    def __init__(self, prefix='bizhi'):
+        self.prefix = prefix
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def counter(self, name, **labels):
+        """
+        Returns:
+            名称相同且包含给定标签的计数器之和
+        """
+        labels = set(labels.items())
+        with self.lock:
+            return sum(v for (n, l), v in self.counters.items() if n == name and labels <= set(l))
+
+    def summary(self):
+        """
+        Returns:
+            一行汇总: 页数、图片数、吞吐量、各直方图的p50/p95与状态码分布
+        """
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        downloaded = self.counter('download_bytes_total')
+        parts = [
+            f"页面 {self.counter('pages_total')}(未修改{self.counter('pages_not_modified_total')})",
+            f"图片 下载{self.counter('images_total', result='downloaded')}"
+            f"/跳过{self.counter('images_total', result='skipped')}"
+            f"/失败{self.counter('images_total', result='failed')}",
+            f"{downloaded / 1024 / 1024:.1f} MB {downloaded / elapsed / 1024 / 1024:.2f} MB/s",
+            f"重试 {self.counter('retries_total')}",
+        ]
+        with self.lock:
+            for (name, labels), h in sorted(self.histograms.items()):
+                if h.count:
+                    parts.append(f"{name}{format_labels(labels)} p50 {h.quantile(0.5) * 1000:.0f}ms "
+                                 f"p95 {h.quantile(0.95) * 1000:.0f}ms")
+            statuses = {}
+            for (name, labels), v in self.counters.items():
+                if name == 'requests_total':
+                    status = dict(labels).get('status')
+                    statuses[status] = statuses.get(status, 0) + v
+        if statuses:
+            parts.append('状态码 ' + ' '.join(f'{k}:{v}' for k, v in sorted(statuses.items(), key=str)))
+        return '，'.join(parts)
+
+    def prometheus(self):
+        """
+        Returns:
+            Prometheus文本格式
+        """
+        lines = []
+        with self.lock:
+            for kind, items in (('counter', self.counters), ('gauge', self.gauges)):
+                typed = set()
+                for (name, labels), v in sorted(items.items()):
+                    name = f'{self.prefix}_{name}'
+                    if name not in typed:
+                        lines.append(f'# TYPE {name} {kind}')
+                        typed.add(name)
+                    lines.append(f'{name}{format_labels(labels)} {v}')
+            typed = set()
+            for (name, labels), h in sorted(self.histograms.items()):
+                name = f'{self.prefix}_{name}'
+                if name not in typed:
+                    lines.append(f'# TYPE {name} histogram')
+                    typed.add(name)
+                cumulative = 0
+                for bound, n in zip([str(b) for b in h.buckets] + ['+Inf'], h.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {h.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+
+class Reporter:
+    """
+    定期以INFO级别输出汇总
+    """
+
+    def __init__(self, metrics, interval=30):
+        """
+        Args:
+            metrics: Metrics
+            interval: 输出间隔(秒)
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+
+    def loop(self):
+        while not self.stopped.wait(self.interval):
+            logger.info(self.metrics.summary())
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+def serve(metrics, port, host='127.0.0.1'):
+    """
+    在后台线程提供/metrics, 供Prometheus抓取
+
+    Args:
+        metrics: Metrics
+        port: 端口
+        host: 监听地址, 默认只允许本机访问
+
+    Returns:
+        HTTP服务器, 结束时调用shutdown()
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"指标地址: http://{host}:{server.server_port}/metrics")
+    return server
@@ -0,0 +1,165 @@
+"""
+下载后的图片检查
+
+在进程池中解码图片, 检查是否为完整有效的图片, 记录格式、尺寸与感知哈希(dHash)到索引中
+与已有图片的感知哈希相近的图片视为重复, 索引中记为duplicate, 默认不删除
+只删除本次下载的无效图片(下次运行重新下载); 运行前已有的文件只在索引中标记, 从不删除
+需要安装Pillow, 没有时不检查
+"""
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+
+def dhash(image, size=8):
+    """
+    差值哈希: 缩小为(size+1)*size的灰度图, 比较每行相邻像素的亮度
+
+    Args:
+        image: PIL图片
+        size: 每行的位数, 哈希共size*size位
+
+    Returns:
+        int
+    """
+    pixels = image.convert('L').resize((size + 1, size), Image.BILINEAR).tobytes()
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            bits = bits << 1 | (pixels[i] < pixels[i + 1])
+    return bits
+
+
+def inspect_image(path):
+    """
+    解码图片并计算感知哈希, 在子进程中运行
+
+    Args:
+        path: 图片路径
+
+    Returns:
+        {'valid', 'format', 'width', 'height', 'phash', 'seconds'}, 无效时为{'valid': False, 'error', 'seconds'}
+    """
+    start = time.perf_counter()
+    try:
+        with Image.open(path) as image:
+            format, (width, height) = image.format, image.size
+            # JPEG按DCT缩放解码, 只需完整解码的一小部分时间, 文件被截断时仍会报错
+            image.draft('RGB', (64, 64))
+            image.load()
+            phash = dhash(image)
+        return {'valid': True, 'format': format, 'width': width, 'height': height, 'phash': f'{phash:016x}',
+                'seconds': time.perf_counter() - start}
+    except (OSError, SyntaxError, ValueError) as e:
+        return {'valid': False, 'error': str(e), 'seconds': time.perf_counter() - start}
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class PostProcessor:
+    """
+    下载后检查图片的进程池
+
+    submit立即返回, 解码在子进程中进行, 不占用下载线程; 结果在回调中写入索引并判断是否重复
+    """
+
+    def __init__(self, index, workers=None, threshold=4, remove_duplicates=False, metrics=None):
+        """
+        Args:
+            index: ImageIndex
+            workers: 进程数, 默认为CPU数
+            threshold: 感知哈希的汉明距离不超过该值时视为重复
+            remove_duplicates: 是否删除本次下载的重复图片, 运行前已有的文件不受影响
+            metrics: Metrics, 记录检查结果与耗时
+        """
+        self.index = index
+        self.threshold = threshold
+        self.remove_duplicates = remove_duplicates
+        self.metrics = metrics
+        self.executor = ProcessPoolExecutor(workers)
+        # 已有图片的感知哈希, 判断重复时逐个比较
+        self.known = index.phashes()
+        self.lock = threading.Lock()
+        self.counts = {'valid': 0, 'invalid': 0, 'duplicate': 0}
+
+    def submit(self, image_hash, path, downloaded=True):
+        """
+        提交一张已下载的图片
+
+        Args:
+            image_hash: 图片哈希
+            path: 图片路径
+            downloaded: 是否为本次运行下载的文件, 为False时只在索引中标记, 不删除
+        """
+        future = self.executor.submit(inspect_image, path)
+        future.add_done_callback(lambda f: self.done(image_hash, path, downloaded, f))
+
+    def find_duplicate(self, phash):
+        for known, image_hash in self.known:
+            if hamming(known, phash) <= self.threshold:
+                return image_hash
+        return None
+
+    def done(self, image_hash, path, downloaded, future):
+        try:
+            info = future.result()
+        except Exception as e:
+            logger.error(f"图片检查失败 {path}: {e}")
+            return
+        with self.lock:
+            if not info['valid']:
+                result = 'invalid'
+                logger.warning(f"图片无效{'，删除' if downloaded else ''}: {os.path.basename(path)} ({info['error']})")
+                self.index.mark_invalid(image_hash, info['error'])
+                if downloaded:
+                    self.remove(path)
+            else:
+                phash = int(info['phash'], 16)
+                self.index.mark_inspected(image_hash, info['format'], info['width'], info['height'], info['phash'])
+                original = self.find_duplicate(phash)
+                if original is not None and original != image_hash:
+                    result = 'duplicate'
+                    logger.debug(f"图片与 {original} 重复: {os.path.basename(path)}")
+                    self.index.mark_duplicate(image_hash, original)
+                    if self.remove_duplicates and downloaded:
+                        self.remove(path)
+                else:
+                    result = 'valid'
+                    self.known.append((phash, image_hash))
+            self.counts[result] += 1
+        if self.metrics is not None:
+            self.metrics.inc('postprocess_total', result=result)
+            self.metrics.observe('inspect_seconds', info['seconds'])
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logger.error(f"删除图片失败 {path}: {e}")
+
+    def close(self):
+        """
+        等待所有检查完成
+
+        Returns:
+            {'valid', 'invalid', 'duplicate'}数量
+        """
+        self.executor.shutdown(wait=True)
+        return self.counts
+
+
+def available():
+    return Image is not None
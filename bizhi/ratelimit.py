@@ -0,0 +1,215 @@
+import time
+import asyncio
+import threading
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """
+    令牌桶, 以rate个/秒的速度补充令牌, 最多积攒burst个
+
+    线程与协程都可以使用, 同步调用acquire, 异步调用acquire_async
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        Args:
+            rate: 每秒补充的令牌数, 即允许的请求速率
+            burst: 桶容量, 允许的瞬时突发请求数
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """
+        预定一个令牌
+
+        Returns:
+            需要等待的秒数, 0表示立即可用
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # 令牌可以透支, 透支部分按速率排队等待
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def wait_time(self):
+        """
+        不预定令牌, 只查询下一个令牌可用前需要等待的秒数
+        """
+        with self.lock:
+            tokens = min(self.burst, self.tokens + (time.monotonic() - self.updated) * self.rate)
+            return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class RateLimiter:
+    """
+    按主机分别限速, 每个主机一个令牌桶, rate为None时不限速
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        Args:
+            rate: 每个主机每秒的请求数, None表示不限
+            burst: 每个主机允许的瞬时突发请求数
+        """
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def acquire(self, url):
+        if self.rate is not None:
+            self.bucket(url).acquire()
+
+    def wait_time(self, url):
+        return self.bucket(url).wait_time() if self.rate is not None else 0
+
+    async def acquire_async(self, url):
+        if self.rate is not None:
+            await self.bucket(url).acquire_async()
+
+
+class AIMDController:
+    """
+    按AIMD(加性增、乘性减)调整同时进行的请求数上限
+
+    每完成约limit个请求评估一次:
+    出现429/503、错误率超过error_rate或首字节延迟中位数超过最低值的tolerance倍时, 上限乘以backoff;
+    上一次增加后吞吐量反而下降超过10%时撤销增加; 否则若这段时间内请求数达到过上限, 上限加1
+
+    线程与协程都可以使用, 同步调用acquire, 异步调用acquire_async, 请求结束后调用release记录结果
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=32, window=8, backoff=0.5, tolerance=2.0, error_rate=0.1):
+        """
+        Args:
+            initial: 初始上限
+            minimum: 最小上限
+            maximum: 最大上限
+            window: 每次评估至少需要的完成数
+            backoff: 减小时的乘数
+            tolerance: 延迟超过最低值的倍数时认为服务器开始排队
+            error_rate: 错误率阈值
+        """
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.error_rate = error_rate
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.waiters = []
+        self.samples = []
+        self.saturated = False
+        self.started = time.monotonic()
+        self.best_latency = None
+        self.throughput = 0
+        self.increased = False
+        self.history = [self.limit]
+
+    def _try_acquire(self):
+        if self.in_flight < self.limit:
+            self.in_flight += 1
+            if self.in_flight == self.limit:
+                self.saturated = True
+            return True
+        return False
+
+    def at_limit(self):
+        """
+        同时进行的请求数是否已达到上限, 只用于调度, 不占用名额
+        """
+        with self.lock:
+            return self.in_flight >= self.limit
+
+    def acquire(self):
+        with self.condition:
+            while not self._try_acquire():
+                self.condition.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self._try_acquire():
+                    return
+                waiter = loop.create_future()
+                self.waiters.append((loop, waiter))
+            await waiter
+
+    def _wake(self):
+        self.condition.notify_all()
+        for loop, waiter in self.waiters:
+            loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+        self.waiters = []
+
+    def release(self, latency=None, status=None, size=0):
+        """
+        Args:
+            latency: 首字节延迟(秒), 连接失败时为None
+            status: 响应状态码, 连接失败时为None
+            size: 传输的字节数
+        """
+        with self.lock:
+            self.in_flight -= 1
+            self.samples.append((latency, status, size))
+            if len(self.samples) >= max(self.window, self.limit):
+                self._adjust()
+            self._wake()
+
+    def _adjust(self):
+        now = time.monotonic()
+        samples, self.samples = self.samples, []
+        throttled = sum(1 for _, status, _ in samples if status in (429, 503))
+        errors = sum(1 for _, status, _ in samples if status is None or status >= 500)
+        # 只有成功的响应反映服务器的处理延迟, 限流与错误响应通常立即返回
+        latencies = sorted(latency for latency, status, _ in samples if status is not None and status < 400)
+        median = latencies[len(latencies) // 2] if latencies else None
+        if median is not None and (self.best_latency is None or median < self.best_latency):
+            self.best_latency = median
+        throughput = sum(size for _, _, size in samples) / max(now - self.started, 1e-6)
+
+        limit = self.limit
+        if throttled or errors > len(samples) * self.error_rate or \
+                (median is not None and median > self.best_latency * self.tolerance):
+            limit = int(limit * self.backoff)
+        elif self.increased and throughput < self.throughput * 0.9:
+            limit -= 1
+        elif self.saturated:
+            limit += 1
+        limit = max(self.minimum, min(limit, self.maximum))
+
+        self.increased = limit > self.limit
+        self.limit = limit
+        self.throughput = throughput
+        self.saturated = self.in_flight >= limit
+        self.started = now
+        self.history.append(limit)
@@ -1,12 +1,20 @@
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 import os
 import re
-from urllib.parse import urlparse, urljoin
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse, urljoin
+import queue
+import threading
 import logging
 
+from ratelimit import RateLimiter, AIMDController
+from index import ImageIndex, file_checksum
+from extract import EXTRACTORS, DEFAULT_EXTRACTOR
+from metrics import Metrics, Reporter, serve as serve_metrics
+from httpcache import PageCache, NOT_MODIFIED, conditional_headers
+from postprocess import PostProcessor, available as postprocess_available
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -15,9 +23,59 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
+class IncompleteDownload(requests.RequestException):
+    """
+    下载的大小与Content-Length不一致
+    """
+
+
+def range_offset(status, content_range, offset):
+    """
+    根据续传请求的响应确定写入位置
+
+    Args:
+        status: 响应状态码
+        content_range: Content-Range响应头
+        offset: 本地.part文件已有的字节数
+
+    Returns:
+        写入的起始位置, 0表示服务器返回了完整内容, 需从头写入
+    """
+    if status != 206:
+        return 0
+    # bytes 1000-1999/2000
+    match = re.match(r'bytes (\d+)-', content_range or '')
+    if not match or int(match.group(1)) != offset:
+        raise IncompleteDownload(f"Content-Range与请求不一致: {content_range}")
+    return offset
+
+
+# 表示服务器限流的状态码, 等待后重试
+THROTTLE_STATUS = (429, 503)
+
+
+def retry_after(value, attempt):
+    """
+    限流后重试前的等待秒数
+
+    Args:
+        value: Retry-After响应头, 只支持秒数
+        attempt: 第几次尝试
+
+    Returns:
+        秒数, 没有Retry-After时按尝试次数指数增长, 最多60秒
+    """
+    try:
+        return min(float(value), 60)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 60)
+
+
 class BizhiSpider:
     def __init__(self, base_url="https://www.bizhi99.com/2560x1600", download_dir="E:\\just-ads\\Pictures",
-                 max_pages=21):
+                 max_pages=21, rate=2, burst=2, index_path=None,
+                 extractor=DEFAULT_EXTRACTOR, image_host="https://pic.dmjnb.com", cache_path=None,
+                 image_rate=None, image_burst=None):
         """
         初始化爬虫
 
@@ -25,82 +83,163 @@ class BizhiSpider:
             base_url: 目标网页URL
             download_dir: 图片下载目录
             max_pages: 最大翻页数限制
+            rate: 列表页每个主机每秒的请求数
+            burst: 列表页每个主机允许的瞬时突发请求数
+            index_path: 图片索引数据库路径, 默认为下载目录下的index.db
+            extractor: 图片地址的提取后端, 见extract.EXTRACTORS, 默认为stream, 结果与bs4一致
+            image_host: 图片所在的主机, 只下载该主机上的图片
+            cache_path: 列表页缓存数据库路径, 默认为下载目录下的pages.db
+            image_rate: 图片每个主机每秒的请求数, 默认不限, 由并发控制器根据服务器的响应调整
+            image_burst: 图片每个主机允许的瞬时突发请求数, 默认为image_rate
         """
         self.base_url = base_url
         self.download_dir = download_dir
         self.max_pages = max_pages
+        self.extract = EXTRACTORS[extractor]
+        # 列表页与图片分别限速, 按主机各一个令牌桶
+        self.limiter = RateLimiter(rate, burst)
+        self.image_limiter = RateLimiter(image_rate, image_burst or max(1, int(image_rate or 1)))
+        # 图片下载中断后的续传次数与流式写入的块大小
+        self.retries = 3
+        self.chunk_size = 64 * 1024
+        # 请求、解析与下载的指标, 运行时每report_interval秒输出一次汇总
+        self.metrics = Metrics()
+        self.report_interval = 30
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
+        self.configure_concurrency(10, adaptive=False)
 
         # 创建下载目录
         os.makedirs(self.download_dir, exist_ok=True)
 
+        # 已发现与已下载图片的索引, 增量运行时跳过已下载的图片
+        self.index = ImageIndex(index_path or os.path.join(self.download_dir, 'index.db'))
+        # 列表页的ETag/Last-Modified与提取结果, 未修改的页面不再下载与解析
+        self.page_cache = PageCache(cache_path or os.path.join(self.download_dir, 'pages.db'))
+        # 下载后检查图片的进程池, 在run中创建
+        self.postprocessor = None
+
         # URL验证模式
         self.url_pattern = re.compile(
-            r'^https://pic\.dmjnb\.com/pic/[a-f0-9]{32}\?imageMogr2/thumbnail/x\d+/quality/\d+!$'
+            '^' + re.escape(image_host) + r'/pic/[a-f0-9]{32}\?imageMogr2/thumbnail/x\d+/quality/\d+!$'
         )
+        self.hash_pattern = re.compile(r'/pic/([a-f0-9]{32})')
 
-    def fetch_page(self, url):
+    def configure_concurrency(self, max_workers, adaptive=True):
         """
-        获取网页内容
+        设置图片下载的并发数与HTTP连接池大小
+
+        Args:
+            max_workers: 最大并发下载数
+            adaptive: 为True时由AIMD控制器在1到max_workers之间自动调整, 否则固定为max_workers
+        """
+        if adaptive:
+            self.controller = AIMDController(initial=min(4, max_workers), minimum=1, maximum=max_workers)
+        else:
+            self.controller = AIMDController(initial=max_workers, minimum=max_workers, maximum=max_workers)
+        # 每个主机的连接池不小于并发数, 否则多出的线程等待连接或反复新建连接
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_workers + 1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def request_page(self, url, cached=None):
+        """
+        获取网页内容, 给出缓存条目时发送条件请求
 
         Args:
             url: 要访问的URL
+            cached: PageCache.get返回的缓存条目
 
         Returns:
-            BeautifulSoup对象或None
+            (网页内容, (ETag, Last-Modified)), 未修改时网页内容为NOT_MODIFIED, 失败时为None
         """
         try:
-            logger.info(f"正在访问网页: {url}")
-            response = self.session.get(url, timeout=30)
+            logger.debug(f"正在访问网页: {url}")
+            self.limiter.acquire(url)
+            start = time.monotonic()
+            response = self.session.get(url, headers=conditional_headers(cached), timeout=30)
+            self.metrics.observe('page_fetch_seconds', time.monotonic() - start)
+            self.metrics.inc('requests_total', kind='page', status=response.status_code)
+            if response.status_code == 304 and cached:
+                self.metrics.inc('pages_total')
+                self.metrics.inc('pages_not_modified_total')
+                return NOT_MODIFIED, None
             response.raise_for_status()
+            self.metrics.inc('pages_total')
 
             # 检测编码
             if response.encoding == 'ISO-8859-1':
                 response.encoding = 'utf-8'
 
-            soup = BeautifulSoup(response.text, 'html.parser')
-            logger.info("网页获取成功")
-            return soup
+            logger.debug("网页获取成功")
+            return response.text, (response.headers.get('ETag'), response.headers.get('Last-Modified'))
         except requests.RequestException as e:
+            if e.response is None:
+                self.metrics.inc('requests_total', kind='page', status='error')
             logger.error(f"获取网页失败 {url}: {e}")
+            return None, None
+
+    def fetch_page(self, url):
+        """
+        获取网页内容
+
+        Args:
+            url: 要访问的URL
+
+        Returns:
+            网页内容或None
+        """
+        return self.request_page(url)[0]
+
+    def fetch_image_urls(self, url):
+        """
+        获取一页的图片URL, 页面未修改时使用缓存的提取结果
+
+        Args:
+            url: 页面URL
+
+        Returns:
+            图片URL列表, 获取失败时返回None
+        """
+        cached = self.page_cache.get(url)
+        html, validators = self.request_page(url, cached)
+        if html is NOT_MODIFIED:
+            logger.debug(f"网页未修改，使用缓存: {url}")
+            return cached['urls']
+        if html is None:
             return None
+        urls = self.extract_image_urls(html, url)
+        self.page_cache.put(url, validators, urls)
+        return urls
 
-    def extract_image_urls(self, soup):
+    def extract_image_urls(self, html, base_url=None):
         """
         提取图片URL
 
         Args:
-            soup: BeautifulSoup对象
+            html: 网页内容
+            base_url: 解析相对URL的基准, 默认为self.base_url
 
         Returns:
             图片URL列表
         """
-        if not soup:
+        if not html:
             return []
 
-        image_urls = []
-
         # 查找所有class为item的元素下的img标签
-        item_elements = soup.find_all(class_='item')
-        logger.info(f"找到 {len(item_elements)} 个item元素")
-
-        for item in item_elements:
-            # 在item元素内查找img标签
-            img_tags = item.find_all('img')
-            for img in img_tags:
-                # 优先使用data-original属性，如果没有则使用src
-                src = img.get('data-original') or img.get('src')
-                if src:
-                    # 处理相对URL
-                    full_url = urljoin(self.base_url, src)
-                    image_urls.append(full_url)
+        start = time.monotonic()
+        item_count, srcs = self.extract(html)
+        self.metrics.observe('parse_seconds', time.monotonic() - start)
+        logger.debug(f"找到 {item_count} 个item元素")
+
+        # 处理相对URL
+        image_urls = [urljoin(base_url or self.base_url, src) for src in srcs]
 
         # 去重
         unique_urls = list(set(image_urls))
-        logger.info(f"提取到 {len(unique_urls)} 个唯一图片URL")
+        logger.debug(f"提取到 {len(unique_urls)} 个唯一图片URL")
 
         return unique_urls
 
@@ -133,92 +272,380 @@ class BizhiSpider:
             logger.error(f"URL处理失败 {url}: {e}")
             return None
 
+    def image_hash(self, url):
+        """
+        图片URL中的32位十六进制哈希, 作为索引的键
+
+        Returns:
+            哈希或None
+        """
+        match = self.hash_pattern.search(url)
+        return match.group(1) if match else None
+
+    def image_filename(self, url, index):
+        """
+        图片保存的文件名
+
+        Args:
+            url: 图片URL
+            index: 图片索引
+
+        Returns:
+            文件名
+        """
+        parsed_url = urlparse(url)
+        path_parts = parsed_url.path.split('/')
+        if len(path_parts) >= 3:
+            # 使用哈希值作为文件名
+            hash_part = path_parts[2].split('?')[0]
+            return f"{hash_part}.jpg"
+        # 使用索引作为文件名
+        return f"image_{index:04d}.jpg"
+
+    def range_request(self, part):
+        """
+        续传请求的起始位置与请求头
+
+        Args:
+            part: .part文件路径
+
+        Returns:
+            (本地已有的字节数, 请求头)
+        """
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        return offset, {'Range': f'bytes={offset}-'} if offset else {}
+
+    def open_part(self, part, status, headers, offset):
+        """
+        根据响应确定.part文件的写入位置与完整大小, 与传输方式无关
+
+        Args:
+            part: .part文件路径
+            status: 响应状态码, 不是2xx时已由调用方抛出异常
+            headers: 响应头
+            offset: 请求的起始位置
+
+        Returns:
+            (写入位置, 完整大小), 416时删除本地部分并返回None, 由调用方重新下载;
+            压缩传输时Content-Length为压缩后的大小, 无法校验, 完整大小为None
+
+        Raises:
+            IncompleteDownload: Content-Range与请求不一致, 已删除本地部分
+        """
+        if status == 416:
+            # 本地部分不小于服务器上的文件, 丢弃后重新下载
+            os.remove(part)
+            return None
+        try:
+            offset = range_offset(status, headers.get('Content-Range'), offset)
+        except IncompleteDownload:
+            os.remove(part)
+            raise
+        length = headers.get('Content-Length')
+        expected = offset + int(length) if length and not headers.get('Content-Encoding') else None
+        return offset, expected
+
+    @staticmethod
+    def check_size(part, size, expected):
+        """
+        检查下载完成后的大小, 超出时删除本地部分, 不足时保留以便续传
+
+        Raises:
+            IncompleteDownload: 大小与Content-Length不一致
+        """
+        if expected is not None and size != expected:
+            if size > expected:
+                os.remove(part)
+            raise IncompleteDownload(f"大小不一致: {size} != {expected}")
+
+    def fetch_to_part(self, url, part):
+        """
+        流式下载到.part文件, 已有部分时以Range请求续传
+
+        Args:
+            url: 图片URL
+            part: .part文件路径
+
+        Returns:
+            文件大小
+
+        Raises:
+            requests.RequestException: 请求失败或大小与Content-Length不一致
+        """
+        offset, headers = self.range_request(part)
+        # 先等待令牌, 再占用一个并发名额, 控制器只统计真正发往服务器的请求; 结束时报告首字节延迟、状态码与传输量
+        self.image_limiter.acquire(url)
+        self.controller.acquire()
+        latency = status = opened = None
+        written = 0
+        start = time.monotonic()
+        try:
+            with self.session.get(url, headers=headers, stream=True, timeout=60) as response:
+                latency = time.monotonic() - start
+                status = response.status_code
+                if status != 416:
+                    response.raise_for_status()
+                opened = self.open_part(part, status, response.headers, offset)
+                if opened is not None:
+                    with open(part, 'ab' if opened[0] else 'wb') as f:
+                        for chunk in response.iter_content(self.chunk_size):
+                            f.write(chunk)
+                            written += len(chunk)
+        finally:
+            self.controller.release(latency, status, written)
+            self.record_request(start, status, written)
+        if opened is None:
+            return self.fetch_to_part(url, part)
+        offset, expected = opened
+        self.check_size(part, offset + written, expected)
+        return offset + written
+
+    def record_request(self, start, status, size):
+        """
+        记录一次图片请求的耗时、状态码与传输量
+
+        Args:
+            start: 开始时间(time.monotonic)
+            status: 响应状态码, 连接失败时为None
+            size: 传输的字节数
+        """
+        self.metrics.observe('download_seconds', time.monotonic() - start)
+        self.metrics.inc('requests_total', kind='image', status=status or 'error')
+        self.metrics.inc('download_bytes_total', size)
+        self.metrics.set('download_concurrency', self.controller.limit)
+
+    def retry_wait(self, attempt, filename, error, status=None, headers=None):
+        """
+        下载失败后的重试决定: 服务器限流时按Retry-After等待后重试, 其他HTTP错误不重试, 中断时立即续传
+
+        Args:
+            attempt: 第几次尝试
+            filename: 文件名, 用于日志
+            error: 异常
+            status: HTTP错误的状态码, 连接中断或大小不一致时为None
+            headers: HTTP错误的响应头
+
+        Returns:
+            重试前等待的秒数, 不重试时为None
+        """
+        if attempt == self.retries or (status is not None and status not in THROTTLE_STATUS):
+            return None
+        if status is None:
+            self.metrics.inc('retries_total', reason='interrupted')
+            logger.warning(f"图片下载中断，续传重试 [{attempt}/{self.retries}] {filename}: {error}")
+            return 0
+        wait = retry_after(headers.get('Retry-After') if headers else None, attempt)
+        self.metrics.inc('retries_total', reason='throttled')
+        logger.warning(f"服务器限流({status})，{wait:.0f}秒后重试 [{attempt}/{self.retries}] {filename}")
+        return wait
+
+    def record_existing(self, image_hash, url, filename, filepath):
+        """
+        已存在的图片补记到索引中并检查, 索引建立前已下载的图片也会补记
+        """
+        logger.debug(f"图片已存在，跳过: {filename}")
+        self.metrics.inc('images_total', result='skipped')
+        if image_hash:
+            # 已检查为无效且未被替换的文件保持invalid, 不再计算校验和与检查
+            if self.invalid_on_disk({image_hash: filename}):
+                return
+            self.index.mark_done(image_hash, url, filename, os.path.getsize(filepath), file_checksum(filepath))
+            self.postprocess(image_hash, filepath, existing=True)
+
+    def finish_download(self, image_hash, url, filename, filepath, size):
+        """
+        下载完成: 计算校验和, .part改为正式文件名, 记入索引并交给检查进程池
+        """
+        part = filepath + '.part'
+        checksum = file_checksum(part)
+        os.replace(part, filepath)
+        if image_hash:
+            self.index.mark_done(image_hash, url, filename, size, checksum)
+            self.postprocess(image_hash, filepath)
+        self.metrics.inc('images_total', result='downloaded')
+        logger.debug(f"图片下载完成: {filename} ({size / 1024:.1f} KB)")
+
     def download_image(self, url, index, total):
         """
         下载单张图片
 
+        流式写入.part文件, 完整后改名, 中断的下载以Range请求从已有部分续传
+
         Args:
             url: 图片URL
             index: 图片索引
-            total: 总图片数
+            total: 总图片数, 流水线下载时未知, 为None
 
         Returns:
             (成功状态, 文件名, 错误信息)
         """
         try:
             # 从URL提取文件名
-            parsed_url = urlparse(url)
-            path_parts = parsed_url.path.split('/')
-            if len(path_parts) >= 3:
-                # 使用哈希值作为文件名
-                hash_part = path_parts[2].split('?')[0]
-                filename = f"{hash_part}.jpg"
-            else:
-                # 使用索引作为文件名
-                filename = f"image_{index:04d}.jpg"
-
+            filename = self.image_filename(url, index)
             filepath = os.path.join(self.download_dir, filename)
+            image_hash = self.image_hash(url)
 
-            # 检查文件是否已存在
+            # 检查文件是否已存在, 只有完整下载的图片才会改为正式文件名
             if os.path.exists(filepath):
-                logger.info(f"图片已存在，跳过: {filename}")
+                self.record_existing(image_hash, url, filename, filepath)
                 return True, filename, None
 
             # 下载图片
-            logger.info(f"正在下载图片 [{index}/{total}]: {filename}")
-            response = self.session.get(url, timeout=60)
-            response.raise_for_status()
-
-            # 保存图片
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
-
-            file_size = os.path.getsize(filepath) / 1024  # KB
-            logger.info(f"图片下载完成: {filename} ({file_size:.1f} KB)")
-
+            logger.debug(f"正在下载图片 [{index}/{total or '?'}]: {filename}")
+            for attempt in range(1, self.retries + 1):
+                try:
+                    size = self.fetch_to_part(url, filepath + '.part')
+                    break
+                except requests.RequestException as e:
+                    response = e.response if isinstance(e, requests.HTTPError) else None
+                    wait = self.retry_wait(attempt, filename, e,
+                                           response.status_code if response is not None else None,
+                                           response.headers if response is not None else None)
+                    if wait is None:
+                        raise
+                    time.sleep(wait)
+            self.finish_download(image_hash, url, filename, filepath, size)
             return True, filename, None
 
         except requests.RequestException as e:
             error_msg = f"下载失败: {e}"
             logger.error(f"图片下载失败 {url}: {e}")
+            self.record_failure(url, error_msg)
             return False, None, error_msg
         except Exception as e:
             error_msg = f"保存失败: {e}"
             logger.error(f"图片保存失败 {url}: {e}")
+            self.record_failure(url, error_msg)
             return False, None, error_msg
 
-    def crawl_all_pages(self):
+    def postprocess(self, image_hash, filepath, existing=False):
         """
-        爬取所有页面的图片URL
+        将已下载的图片交给检查进程池, 没有进程池时不检查
+
+        Args:
+            image_hash: 图片哈希
+            filepath: 图片路径
+            existing: 为True时是运行前已有的文件, 已检查过的不再检查, 检查结果只记入索引, 不删除文件
+        """
+        if self.postprocessor is None:
+            return
+        if existing:
+            record = self.index.get(image_hash)
+            if record and record['phash']:
+                return
+        self.postprocessor.submit(image_hash, filepath, downloaded=not existing)
+
+    def start_postprocess(self, enabled):
+        """
+        创建检查进程池
+
+        Args:
+            enabled: 是否检查下载的图片
+        """
+        if not enabled:
+            return
+        if not postprocess_available():
+            logger.warning("未安装Pillow，不检查下载的图片")
+            return
+        self.postprocessor = PostProcessor(self.index, metrics=self.metrics)
+
+    def finish_postprocess(self):
+        """
+        等待检查完成并输出结果
+        """
+        if self.postprocessor is None:
+            return
+        counts = self.postprocessor.close()
+        self.postprocessor = None
+        logger.info(f"图片检查: 有效 {counts['valid']}，无效 {counts['invalid']}，重复 {counts['duplicate']}")
+
+    def record_failure(self, url, error):
+        self.metrics.inc('images_total', result='failed')
+        image_hash = self.image_hash(url)
+        if image_hash:
+            self.index.mark_failed(image_hash, url, error)
+
+    def invalid_on_disk(self, filenames):
+        """
+        检查为无效、文件仍在下载目录中且大小未变的图片
+
+        下载的无效图片已被删除, 下次运行重新下载; 仍在的是运行前已有的文件, 不再重复下载与检查
+
+        Args:
+            filenames: {图片哈希: 文件名}
 
         Returns:
-            所有页面的图片URL列表
+            图片哈希集合
+        """
+        result = set()
+        for image_hash, (filename, size) in self.index.invalid(filenames).items():
+            path = os.path.join(self.download_dir, filename or filenames[image_hash])
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                result.add(image_hash)
+        return result
+
+    def page_url(self, page):
+        """
+        列表第page页的URL
+        """
+        return f'{self.base_url}/{page}.html'
+
+    def filter_known(self, page, urls):
+        """
+        在索引中登记一页的图片, 去掉已下载的
+
+        Args:
+            page: 页面URL
+            urls: 处理后的图片URL列表
+
+        Returns:
+            (未下载的URL集合, 已下载的数量), 运行前已有的无效文件也算作已下载
+        """
+        hashes = {url: self.image_hash(url) for url in urls}
+        known = self.index.known(h for h in hashes.values() if h)
+        known |= self.invalid_on_disk({h: self.image_filename(url, 0) for url, h in hashes.items() if h})
+        self.index.add(page, [(h, url) for url, h in hashes.items() if h and h not in known])
+        new_urls = {url for url, h in hashes.items() if h not in known}
+        return new_urls, len(urls) - len(new_urls)
+
+    def crawl_pages(self):
+        """
+        逐页爬取图片URL, 每解析完一页立即产出
+
+        Returns:
+            (页码, 该页图片URL列表)的迭代器, 某页获取失败时停止
         """
-        all_image_urls = []
-        current_url = self.base_url
         page_count = 0
 
         logger.info("开始爬取所有页面...")
 
-        while current_url and page_count < self.max_pages:
+        while page_count < self.max_pages:
             page_count += 1
 
-            current_url = f'{self.base_url}/{page_count}.html'
+            current_url = self.page_url(page_count)
 
-            logger.info(f"正在处理第 {page_count} 页: {current_url}")
+            logger.debug(f"正在处理第 {page_count} 页: {current_url}")
 
-            # 获取当前页面
-            soup = self.fetch_page(current_url)
-            if not soup:
+            # 获取当前页面并提取图片URL
+            page_urls = self.fetch_image_urls(current_url)
+            if page_urls is None:
                 logger.error(f"第 {page_count} 页获取失败，停止翻页")
                 break
 
-            # 提取当前页面的图片URL
-            page_urls = self.extract_image_urls(soup)
+            yield page_count, page_urls
+
+    def crawl_all_pages(self):
+        """
+        爬取所有页面的图片URL
+
+        Returns:
+            所有页面的图片URL列表
+        """
+        all_image_urls = []
+        page_count = 0
+        for page_count, page_urls in self.crawl_pages():
             all_image_urls.extend(page_urls)
-            logger.info(f"第 {page_count} 页提取到 {len(page_urls)} 个图片URL，累计 {len(all_image_urls)} 个")
-            # 添加延迟，避免请求过于频繁
-            time.sleep(1)
+            logger.debug(f"第 {page_count} 页提取到 {len(page_urls)} 个图片URL，累计 {len(all_image_urls)} 个")
 
         # 去重
         unique_urls = list(set(all_image_urls))
@@ -226,13 +653,26 @@ class BizhiSpider:
 
         return unique_urls
 
-    def run(self, max_workers=5):
+    def run(self, max_workers=16, queue_size=100, full=False, adaptive=True, metrics_port=None, postprocess=True):
         """
         运行爬虫主流程
 
+        爬取、验证与下载流水线进行: 每解析完一页, 其图片URL验证处理后立即放入下载队列,
+        下载线程同时从队列取出下载. 队列有上限, 下载跟不上时暂停翻页
+        索引中已下载的图片不再入队, 某页的图片全部已下载时停止翻页
+
         Args:
-            max_workers: 最大并发下载数
+            max_workers: 最大并发下载数, adaptive为True时是自动调整的上限
+            queue_size: 下载队列上限
+            full: 为True时不因整页已下载而提前停止翻页
+            adaptive: 是否根据延迟、限流与吞吐量自动调整并发数
+            metrics_port: 提供Prometheus格式指标的本机端口, 默认不提供
+            postprocess: 是否在进程池中检查下载的图片, 标记无效与重复的图片
         """
+        self.configure_concurrency(max_workers, adaptive)
+        self.start_postprocess(postprocess)
+        reporter = Reporter(self.metrics, self.report_interval).start()
+        server = serve_metrics(self.metrics, metrics_port) if metrics_port is not None else None
         logger.info("=" * 50)
         logger.info("开始执行爬虫任务")
         logger.info(f"目标URL: {self.base_url}")
@@ -240,59 +680,76 @@ class BizhiSpider:
         logger.info(f"最大翻页数: {self.max_pages}")
         logger.info("=" * 50)
 
-        # 步骤1-2: 爬取所有页面的图片URL
-        raw_urls = self.crawl_all_pages()
-        if not raw_urls:
-            logger.warning("未找到图片URL，任务终止")
-            return
-
-        # 步骤3-4: 验证和处理URL
-        processed_urls = []
-        for url in raw_urls:
-            processed_url = self.validate_and_process_url(url)
-            if processed_url:
-                processed_urls.append(processed_url)
-
-        logger.info(f"有效URL数量: {len(processed_urls)}")
-
-        if not processed_urls:
-            logger.warning("没有有效的图片URL，任务终止")
-            return
-
-        # 步骤5: 并发下载图片
-        success_count = 0
-        failed_count = 0
+        downloads = queue.Queue(maxsize=queue_size)
+        counts = {'success': 0, 'failed': 0, 'known': 0}
+        lock = threading.Lock()
 
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            # 提交所有下载任务
-            future_to_url = {
-                executor.submit(self.download_image, url, i + 1, len(processed_urls)): url
-                for i, url in enumerate(processed_urls)
-            }
-
-            # 处理完成的任务
-            for future in as_completed(future_to_url):
-                url = future_to_url[future]
+        def worker():
+            while True:
+                item = downloads.get()
+                if item is None:
+                    break
+                url, index = item
                 try:
-                    success, filename, error = future.result()
-                    if success:
-                        success_count += 1
-                    else:
-                        failed_count += 1
+                    success, filename, error = self.download_image(url, index, None)
+                    if not success:
                         logger.error(f"下载失败: {url} - {error}")
                 except Exception as e:
-                    failed_count += 1
+                    success = False
                     logger.error(f"任务执行异常 {url}: {e}")
+                with lock:
+                    counts['success' if success else 'failed'] += 1
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(max_workers)]
+        for t in workers:
+            t.start()
 
-                # 添加短暂延迟，避免请求过于频繁
-                time.sleep(0.1)
+        # 步骤1-4: 逐页爬取, 验证和处理URL后放入下载队列
+        seen = set()
+        try:
+            for page_count, page_urls in self.crawl_pages():
+                valid = []
+                for url in page_urls:
+                    processed_url = self.validate_and_process_url(url)
+                    if processed_url and processed_url not in seen:
+                        seen.add(processed_url)
+                        valid.append(processed_url)
+                new_urls, known = self.filter_known(self.page_url(page_count), valid)
+                counts['known'] += known
+                self.metrics.inc('images_total', known, result='skipped')
+                start = len(seen) - len(valid) + 1
+                for index, url in enumerate(valid, start):
+                    if url in new_urls:
+                        downloads.put((url, index))
+                logger.debug(f"第 {page_count} 页提取到 {len(page_urls)} 个图片URL，有效 {len(valid)} 个，"
+                            f"已下载 {known} 个，累计 {len(seen)} 个")
+                if valid and not new_urls and not full:
+                    logger.info(f"第 {page_count} 页的图片均已下载，停止翻页")
+                    break
+        finally:
+            # 步骤5: 等待下载完成
+            for _ in workers:
+                downloads.put(None)
+            for t in workers:
+                t.join()
+            self.finish_postprocess()
+            reporter.stop()
+            if server is not None:
+                server.shutdown()
+
+        if not seen:
+            logger.warning("没有有效的图片URL，任务终止")
+            return
 
         # 输出统计信息
         logger.info("=" * 50)
         logger.info("任务完成统计:")
-        logger.info(f"总图片数: {len(processed_urls)}")
-        logger.info(f"成功下载: {success_count}")
-        logger.info(f"失败下载: {failed_count}")
+        logger.info(f"总图片数: {len(seen)}")
+        logger.info(f"此前已下载: {counts['known']}")
+        logger.info(f"成功下载: {counts['success']}")
+        logger.info(f"失败下载: {counts['failed']}")
+        logger.info(f"下载并发数: 最终 {self.controller.limit}，最高 {max(self.controller.history)}")
+        logger.info(self.metrics.summary())
         logger.info(f"下载目录: {self.download_dir}")
         logger.info("=" * 50)
 
@@ -308,7 +765,7 @@ def main():
 
     # 创建爬虫实例并运行
     spider = BizhiSpider(base_url, download_dir, max_pages)
-    spider.run(max_workers=10)
+    spider.run()
 
 
 if __name__ == "__main__":
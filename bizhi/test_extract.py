@@ -0,0 +1,41 @@
+"""
+各提取后端与bs4的结果一致性
+
+python -m pytest test_extract.py
+"""
+import unittest
+
+import extract
+
+# 列表页常见的不规范标签
+PAGES = {
+    'unclosed_li': '<ul><li class="item"><img src="a"><li class="x"><img src="b"></ul>',
+    'div_in_p': '<p class="item"><div><img src="a"></div></p>',
+    'unclosed_item': '<div class="item"><img src="a"><div class="item"><img data-original="b" src="c">',
+    'stray_end_tag': '<div class="item"></span><img src="a"></div><img src="b"></div>',
+    'self_closing': '<div class="item"/><img src="a"><span class="item"/><img src="b">',
+    'nested_items': '<ul class="item list"><li class="item"><img src="a"></li><img src="b"></ul><img src="c">',
+    'table': '<table><tr class="item"><td><img src="a"><tr><td><img src="b"></table>',
+    'empty_src': '<li class="item"><img src=""><img data-original="" src="a"><img></li>',
+}
+
+
+class ExtractorTest(unittest.TestCase):
+    def assert_same_as_bs4(self, name):
+        for key, html in PAGES.items():
+            with self.subTest(page=key):
+                items, srcs = extract.EXTRACTORS[name](html)
+                expected_items, expected_srcs = extract.extract_bs4(html)
+                self.assertEqual(items, expected_items)
+                # 嵌套的item中bs4会重复列出同一图片, 爬虫只使用去重后的集合
+                self.assertEqual(set(srcs), set(expected_srcs))
+
+    def test_stream(self):
+        self.assert_same_as_bs4('stream')
+
+    def test_default(self):
+        self.assert_same_as_bs4(extract.DEFAULT_EXTRACTOR)
+
+
+if __name__ == '__main__':
+    unittest.main()
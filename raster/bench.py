@@ -0,0 +1,222 @@
+'''
+栅格流程基准测试
+生成指定大小、无数据比例与坐标系的合成GeoTIFF, 依次运行main中的重投影、rgb编码、合并重投影编码与各级别切片,
+清单、输出目录指向临时目录, 记录吞吐量与内存峰值, 并与保存的基准比较
+没有gdalwarp或rio rgbify时跳过重投影与rgb编码两个阶段
+最后比较各瓦片编码(tiler.ENCODINGS)的大小与编解码速度
+
+python bench.py --width 7200 --height 3600 --zooms 0-4,5-6
+python bench.py --encoding webp
+python bench.py --save-baseline
+'''
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_bounds
+from rasterio.warp import transform_bounds
+
+import main as pipeline
+import metrics
+import terrainrgb
+import tiler
+from manifest import Manifest
+
+# 与main.py相同的目标范围, 分辨率按合成栅格大小缩放
+target_bounds = pipeline.target_bounds
+
+# 调用外部命令的阶段: (命令, 检查是否可用的命令)
+TOOLS = {
+    'reproject': ('gdalwarp', 'gdalwarp --version'),
+    'rgbify': ('rio rgbify', 'rio rgbify --help'),
+}
+
+baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+
+def synthetic(path, width, height, nodata=0.3, crs='EPSG:4326', seed=0):
+    '''
+    生成类似landscan的合成栅格: int32人口值, 按比例随机设为无数据, 覆盖全球
+    :param nodata: 无数据像素比例
+    '''
+    rng = np.random.default_rng(seed)
+    bounds = transform_bounds('EPSG:4326', crs, -180, -85, 180, 85)
+    profile = {
+        'driver': 'GTiff', 'dtype': 'int32', 'count': 1, 'width': width, 'height': height,
+        'crs': crs, 'transform': from_bounds(*bounds, width, height), 'nodata': -2147483647,
+        'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'DEFLATE', 'BIGTIFF': 'IF_NEEDED',
+    }
+    with rasterio.open(path, 'w', **profile) as dst:
+        for window in terrainrgb.strips(width, height, 512):
+            shape = (int(window.height), int(window.width))
+            data = rng.gamma(0.5, 200, shape).astype('int32')
+            data[rng.random(shape) < nodata] = profile['nodata']
+            dst.write(data, 1, window=window)
+    return path
+
+
+def available(command):
+    '''
+    外部命令是否可用
+    '''
+    try:
+        return subprocess.run(command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+    except OSError:
+        return False
+
+
+def run(width=3600, height=1800, nodata=0.3, crs='EPSG:4326', zooms=('0-3', '4-5'),
+        workers=None, processes=None, workdir=None, encoding='png', format='dir'):
+    '''
+    运行全部阶段, 各阶段调用main中的函数, 包括清单检查与切片的暂存替换
+    运行期间main的清单、输出目录、目标分辨率与报告指向workdir与本次的设置, 结束后恢复
+    :param processes: 切片占用的核数, 默认为全部核
+    :param format: 切片输出格式, dir、mbtiles或pmtiles
+    :return: {阶段: 指标}
+    '''
+    workers = workers or os.cpu_count()
+    workdir = workdir or tempfile.mkdtemp(prefix='raster-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    # 目标栅格与源栅格像素数相近
+    step = (target_bounds[2] - target_bounds[0]) / width
+    report = metrics.Report()
+    settings = {
+        'temp_path': os.path.join(workdir, 'tif_3857'),
+        'rgb_path': os.path.join(workdir, 'tif_rgb'),
+        'target_res': (step, step),
+        'manifest': Manifest(os.path.join(workdir, 'manifest.json')),
+        'report': report,
+    }
+    saved = {name: getattr(pipeline, name) for name in list(settings) + ['tiles_path']}
+    for name, value in settings.items():
+        setattr(pipeline, name, value)
+    try:
+        for path in (pipeline.temp_path, pipeline.rgb_path):
+            os.makedirs(path, exist_ok=True)
+        src = synthetic(os.path.join(workdir, 'src.tif'), width, height, nodata, crs)
+
+        warped = None
+        if available(TOOLS['reproject'][1]):
+            warped = pipeline.reproject(src, os.path.join(pipeline.temp_path, os.path.basename(src)), workers)
+        else:
+            print(f"没有{TOOLS['reproject'][0]}, 跳过reproject与rgbify阶段")
+        if warped and not available(TOOLS['rgbify'][1]):
+            print(f"没有{TOOLS['rgbify'][0]}, 跳过rgbify阶段")
+        elif warped:
+            # 与合并阶段的输出同名, 删除并从清单中去掉, 否则合并阶段认为输出已是最新
+            rgb = pipeline.rgbify(warped, workers, source=src)
+            os.remove(rgb)
+            pipeline.manifest.forget(rgb)
+        fused = pipeline.reproject_rgbify(src, workers)
+        for zoom in zooms:
+            # 每个级别范围单独输出, 从暂存切片整体替换
+            pipeline.tiles_path = os.path.join(workdir, f'tiles-{zoom}')
+            os.makedirs(pipeline.tiles_path, exist_ok=True)
+            pipeline.tiles(fused, zoom, processes=processes, format=format, encoding=tiler.ENCODINGS[encoding])
+    finally:
+        for name, value in saved.items():
+            setattr(pipeline, name, value)
+    report.stopped.set()
+    encodings = tiler.compare_encodings(fused, max(tiler.parse_zoom(z)[1] for z in zooms))
+
+    results = {}
+    for record in report.to_dict()['stages']:
+        result = {'seconds': record['seconds'], 'peak_rss': record['peak_rss']}
+        if record.get('pixels_per_s'):
+            result['pixels_per_s'] = record['pixels_per_s']
+        if record.get('tiles'):
+            result['tiles_per_s'] = record['tiles'] / max(record['seconds'], 1e-6)
+        name = f"tiles {record['zoom']}" if record['stage'] == 'tiles' else record['stage']
+        results[name] = result
+    for name, r in encodings.items():
+        results[f'encode {name}'] = {
+            'bytes_per_tile': r['bytes'] / max(r['tiles'], 1),
+            'encode_tiles_per_s': 1000 / max(r['encode_ms'], 1e-6),
+            'decode_tiles_per_s': 1000 / max(r['decode_ms'], 1e-6),
+            'lossless': r['lossless'],
+        }
+    return {
+        'params': {'width': width, 'height': height, 'nodata': nodata, 'crs': crs, 'zooms': list(zooms),
+                   'workers': workers, 'processes': processes, 'encoding': encoding, 'format': format},
+        'results': results,
+        'workdir': workdir,
+    }
+
+
+def compare(baseline, current, threshold=0.1):
+    '''
+    与基准比较
+    :return: [(阶段, 指标, 基准值, 本次值, 变化比例)]
+    '''
+    rows = []
+    for stage, result in current['results'].items():
+        base = baseline['results'].get(stage, {})
+        for key in ('pixels_per_s', 'tiles_per_s', 'peak_rss',
+                    'bytes_per_tile', 'encode_tiles_per_s', 'decode_tiles_per_s'):
+            if result.get(key) and base.get(key):
+                change = result[key] / base[key] - 1
+                rows.append((stage, key, base[key], result[key], change))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='栅格流程基准测试')
+    parser.add_argument('--width', type=int, default=3600)
+    parser.add_argument('--height', type=int, default=1800)
+    parser.add_argument('--nodata', type=float, default=0.3, help='无数据像素比例')
+    parser.add_argument('--crs', default='EPSG:4326')
+    parser.add_argument('--zooms', default='0-3,4-5', help='逗号分隔的切片级别范围')
+    parser.add_argument('--workers', type=int, default=None, help='重投影编码线程数')
+    parser.add_argument('--processes', type=int, default=None, help='切片占用的核数')
+    parser.add_argument('--encoding', default='png', choices=list(tiler.ENCODINGS), help='切片的瓦片编码')
+    parser.add_argument('--format', default='dir', choices=['dir', 'mbtiles', 'pmtiles'], help='切片输出格式')
+    parser.add_argument('--baseline', default=baseline_path)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--threshold', type=float, default=0.1, help='变化超过该比例时标记')
+    parser.add_argument('--keep', action='store_true', help='保留临时文件')
+    args = parser.parse_args()
+
+    current = run(args.width, args.height, args.nodata, args.crs, args.zooms.split(','),
+                  args.workers, args.processes, encoding=args.encoding, format=args.format)
+    if not args.keep:
+        shutil.rmtree(current['workdir'], ignore_errors=True)
+    del current['workdir']
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['params'] != current['params']:
+            print('基准参数与本次不同, 不比较')
+            baseline = None
+
+    for stage, result in current['results'].items():
+        if 'bytes_per_tile' in result:
+            print(f"{stage:<20} {result['bytes_per_tile'] / 1024:8.1f} KB/tile, "
+                  f"encode {result['encode_tiles_per_s']:.1f} tiles/s, "
+                  f"decode {result['decode_tiles_per_s']:.1f} tiles/s"
+                  f"{'' if result['lossless'] else ', lossy!'}")
+            continue
+        rate = result.get('pixels_per_s') or result.get('tiles_per_s') or 0
+        unit = 'pixels/s' if 'pixels_per_s' in result else 'tiles/s'
+        rss = f"{result['peak_rss'] / 1048576:.0f} MB" if result['peak_rss'] else '-'
+        print(f"{stage:<20} {result['seconds']:8.2f}s {rate:14.1f} {unit:<9} peak {rss}")
+    if baseline:
+        print('\n与基准比较:')
+        for stage, key, base, value, change in compare(baseline, current):
+            # 内存、瓦片大小升高或吞吐量降低为变差
+            worse = change > args.threshold if key in ('peak_rss', 'bytes_per_tile') else change < -args.threshold
+            print(f"{stage:<20} {key:<13} {change * 100:+7.1f}%{'  <-- 变差' if worse else ''}")
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+        print(f'\n已保存基准: {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
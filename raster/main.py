@@ -4,6 +4,12 @@ import shutil
 import time
 import math
 import datetime
+from scheduler import Scheduler, Stage
+import terrainrgb
+import tiler
+import tilestore
+from manifest import Manifest
+import metrics
 
 path_main = r'G:/raster/tif';
 
@@ -13,6 +19,78 @@ rgb_path = r'G:/raster/tif_rgb';
 
 tiles_path = r'G:/raster/raster'
 
+# 切片输出格式: dir为{z}/{x}/{y}.png目录, mbtiles/pmtiles为每年一个单文件
+tiles_format = 'dir'
+
+# 瓦片编码, 可选项见tiler.ENCODINGS, 如无损webp或指定压缩级别与行过滤的png
+tile_encoding = tiler.ENCODINGS['png']
+
+# 切片时每个进程的编码线程数, 进程数为阶段核数除以该值
+tile_encoders = 2
+
+# 构建清单, 记录各产物的输入、参数与输出哈希
+manifest_path = r'G:/raster/manifest.json'
+
+# 运行报告目录
+report_path = r'G:/raster/reports'
+
+# 重投影的目标范围与分辨率, 同gdalwarp -te/-tr
+target_bounds = (-20037508.3428, -20000000.0, 20037491.6572, 20000000.0)
+
+target_res = (1000.0, 1000.0)
+
+# rgb编码的基准值与间隔, 同rio rgbify -b/-i
+rgb_base = 0
+
+rgb_interval = 0.01
+
+# 各阶段默认占用的核数与内存(MB)
+stage_cost = {
+    'reproject': (2, 1536),
+    'rgbify': (2, 1024),
+    'reproject_rgbify': (4, 2048),
+    'reproject_rgbify_stack': (4, 4096),
+    'gdal2tiles': (4, 2048),
+    'tiles': (max(4, (os.cpu_count() or 4) // 2), 2048),
+}
+
+manifest = Manifest(manifest_path)
+
+# 本次运行的指标, 由start创建
+report = None
+
+def measure(name, file=None, **info):
+    '''
+    记录阶段指标, 返回的dict可补充bytes_read、bytes_written、pixels等
+    '''
+    global report
+    if report is None:
+        report = metrics.Report()
+    return report.stage(name, file, **info)
+
+def progress(label):
+    return report.progress(label) if report else None
+
+def target_pixels():
+    _, width, height = terrainrgb.target_grid(target_bounds, target_res)
+    return width * height
+
+def reproject_params():
+    return {'te': target_bounds, 'tr': target_res, 'r': 'bilinear'}
+
+def rgb_params():
+    return {**reproject_params(), 'b': rgb_base, 'i': rgb_interval}
+
+def tiles_params(format='dir'):
+    return {'tilesize': tiler.TILE_SIZE, 'resampling': 'near', 'format': format}
+
+def remove(path):
+    '''
+    删除未记录在清单中的残留输出, 如中途崩溃留下的文件
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+
 def format_seconds(seconds):
     '''
     将秒数格式化为时:分:秒的形式
@@ -23,21 +101,28 @@ def format_seconds(seconds):
     return str(time_delta)
 
 
-def reproject(input_file, output_file):
+def reproject(input_file, output_file, threads=1, mem=None):
     '''
     重投影到EPSG:3857
+    :param threads: gdalwarp线程数
+    :param mem: gdalwarp缓存大小(MB)
     '''
     input_file = os.path.normpath(input_file)
     output_file = os.path.normpath(output_file)
     file_name = os.path.basename(input_file)
-    if os.path.exists(output_file):
+    if manifest.fresh(output_file, [input_file], reproject_params()):
         print(f'reproject {file_name} is exists')
         return output_file
-    cmd = f'gdalwarp -t_srs EPSG:3857 \
+    remove(output_file)
+    options = f'-multi -wo NUM_THREADS={threads}' if threads > 1 else ''
+    if mem:
+        options += f' -wm {mem}'
+    te = ' '.join(map(str, target_bounds))
+    cmd = f'gdalwarp -t_srs EPSG:3857 {options} \
             -dstnodata None \
             -r bilinear \
-            -tr 1000.0 1000.0 \
-            -te -20037508.3428 -20000000.0 20037491.6572 20000000.0 \
+            -tr {target_res[0]} {target_res[1]} \
+            -te {te} \
             -te_srs EPSG:3857 \
             -co TILED=YES \
             -co COMPRESS=DEFLATE \
@@ -46,60 +131,235 @@ def reproject(input_file, output_file):
             {output_file}'
     print(f'\n重投影开始')
     start_time = time.time()
-    subprocess.check_output(cmd, shell=True)
+    with measure('reproject', input_file) as m:
+        subprocess.check_output(cmd, shell=True)
+        m.update(bytes_read=os.path.getsize(input_file), bytes_written=os.path.getsize(output_file),
+                 pixels=target_pixels())
+    manifest.record(output_file, [input_file], reproject_params())
     t = format_seconds(time.time() - start_time)
     print(f"reproject successfully: {output_file}, 耗时: {t}")
     return output_file
 
 
-def rgbify(src):
+def rgbify(src, workers=1, source=None):
     '''
     rgb编码
+    :param workers: rio rgbify进程数
+    :param source: 重投影前的原始文件, 清单中以它作为输入, 因为src在编码后会被删除
     '''
     input_file = os.path.normpath(src)
     file_name = os.path.basename(input_file)
-    output_file = f'{rgb_path}/{file_name}'
-    if os.path.exists(output_file):
+    output_file = os.path.normpath(f'{rgb_path}/{file_name}')
+    source = source or input_file
+    if manifest.fresh(output_file, [source], rgb_params()):
         print(f'rgbify {file_name} is exists')
         return output_file
-    cmd = f'rio rgbify -b 0 -i 0.01 {input_file} {output_file}'
+    remove(output_file)
+    cmd = f'rio rgbify -b {rgb_base} -i {rgb_interval} -j {workers} {input_file} {output_file}'
     print(f'\nrgb编码开始')
     start_time = time.time()
-    subprocess.check_output(cmd, shell=True)
+    with measure('rgbify', source) as m:
+        subprocess.check_output(cmd, shell=True)
+        m.update(bytes_read=os.path.getsize(input_file), bytes_written=os.path.getsize(output_file),
+                 pixels=target_pixels())
+    manifest.record(output_file, [source], rgb_params())
     t = format_seconds(time.time() - start_time)
     print(f"rgbified successfully: {output_file}, 耗时: {t}")
     os.remove(input_file)
+    manifest.forget(input_file)
     return output_file
 
-def gdal2tiles(src, zoom, clean=True):
+def reproject_rgbify(src, workers=1):
+    '''
+    重投影与rgb编码合并为一步, 在内存中逐块完成, 不生成tif_3857中间文件
+    '''
+    input_file = os.path.normpath(src)
+    file_name = os.path.basename(input_file)
+    output_file = os.path.normpath(os.path.join(rgb_path, file_name))
+    if manifest.fresh(output_file, [input_file], rgb_params()):
+        print(f'rgbify {file_name} is exists')
+        return output_file
+    remove(output_file)
+    print(f'\n重投影与rgb编码开始')
+    start_time = time.time()
+    with measure('reproject_rgbify', input_file) as m:
+        terrainrgb.reproject_rgbify(input_file, output_file, target_bounds, target_res,
+                                    rgb_base, rgb_interval, workers,
+                                    progress=progress(f'reproject_rgbify {file_name}'))
+        m.update(bytes_read=os.path.getsize(input_file), bytes_written=os.path.getsize(output_file),
+                 pixels=target_pixels())
+    manifest.record(output_file, [input_file], rgb_params())
+    t = format_seconds(time.time() - start_time)
+    print(f"reproject and rgbified successfully: {output_file}, 耗时: {t}")
+    return output_file
+
+def reproject_rgbify_stack(srcs, workers=1):
+    '''
+    网格相同的多个文件(如各年份的landscan)叠加后一起重投影与rgb编码
+    坐标变换与读取窗口只计算一次, 输出与逐个调用reproject_rgbify相同
+    :return: rgb编码文件列表
+    '''
+    input_files = [os.path.normpath(src) for src in srcs]
+    output_files = [os.path.normpath(os.path.join(rgb_path, os.path.basename(f))) for f in input_files]
+    for output_file in output_files:
+        remove(output_file)
+    print(f'\n{len(input_files)}个文件叠加重投影与rgb编码开始')
+    start_time = time.time()
+    with measure('reproject_rgbify_stack', None, files=[os.path.basename(f) for f in input_files]) as m:
+        terrainrgb.stack_reproject_rgbify(input_files, output_files, target_bounds, target_res,
+                                          rgb_base, rgb_interval, workers,
+                                          progress=progress(f'reproject_rgbify_stack {len(input_files)} files'))
+        m.update(bytes_read=sum(map(os.path.getsize, input_files)),
+                 bytes_written=sum(map(os.path.getsize, output_files)),
+                 pixels=target_pixels() * len(input_files))
+    for input_file, output_file in zip(input_files, output_files):
+        manifest.record(output_file, [input_file], rgb_params())
+    t = format_seconds(time.time() - start_time)
+    print(f"reproject and rgbified successfully: {len(output_files)} files, 耗时: {t}")
+    return output_files
+
+def gdal2tiles(src, zoom, clean=False, processes=4):
+    '''
+    调用gdal2tiles.py切片
+    先输出到{output_path}.staging, 成功后整体替换output_path, 中断后再次运行以--resume只补缺少的瓦片
+    暂存目录的输入与参数记录在清单中, 有变化时删除后重切
+    :param clean: 删除上次中断留下的暂存目录, 全部重切
+    '''
     input_file = os.path.normpath(src)
     file_name = os.path.basename(input_file)
     output_path = os.path.splitext(file_name)[0].split('-').pop()
     output_path = os.path.join(tiles_path, output_path)
-    if clean and os.path.exists(output_path):
-        shutil.rmtree(output_path)
+    params = {**tiles_params('gdal2tiles'), 'zoom': zoom}
+    if manifest.fresh(output_path, [input_file], params, []):
+        print(f'tiles {file_name} is exists')
+        return
+    staging = f'{output_path}.staging'
+    if os.path.exists(staging) and (clean or not manifest.fresh(staging, [input_file], params, [])):
+        shutil.rmtree(staging)
+    manifest.record(staging, [input_file], params, [])
     cmd = f"gdal2tiles.py \
           -p mercator \
           --zoom={zoom} \
           --resampling=near \
           --tilesize=512 \
-          --processes=4 \
+          --processes={processes} \
           --xyz \
           --webviewer=none \
+          --resume \
           -n {input_file} \
-          {output_path}"
+          {staging}"
     try:
         print(f'\n{file_name}开始切片')
         start_time = time.time()
-        subprocess.check_output(cmd, shell=True)
+        with measure('gdal2tiles', input_file, zoom=zoom) as m:
+            m['bytes_read'] = os.path.getsize(input_file)
+            subprocess.check_output(cmd, shell=True)
     except subprocess.CalledProcessError as e:
         if e.returncode != 120:
             print(e)
+            return
+    tilestore.replace(staging, output_path)
+    manifest.forget(staging)
+    manifest.record(output_path, [input_file], params, [])
     t = format_seconds(time.time() - start_time)    
     print(f"created tileset successfully: {output_path}, 耗时: {t}")
 
 
-def start(zoom = '0-5'):
+def tiles(src, zoom, clean=False, processes=None, format=None, encoding=None):
+    '''
+    切片, 由tiler在进程内完成, 输出与gdal2tiles一致
+    已有的级别会保留, 只切缺少的级别, 新级别整级提交
+    clean为True或输入栅格、切片参数有变化时在暂存切片({output_path}.staging或.staging.mbtiles)上全部重切,
+    完成后整体替换, 重切期间读取方仍看到原有的完整切片
+    中断后再次运行时, 输入未变化则从检查点继续
+    :param processes: 进程数, 默认为全部核
+    :param format: dir、mbtiles或pmtiles, 默认为tiles_format
+        pmtiles先写入同名mbtiles再整体转换, mbtiles保留用于之后增加级别
+    :param encoding: 瓦片编码, 默认为tile_encoding
+    '''
+    format = format or tiles_format
+    encoding = encoding or tile_encoding
+    params = {**tiles_params(format), 'encoding': encoding}
+    input_file = os.path.normpath(src)
+    file_name = os.path.basename(input_file)
+    output_path = os.path.splitext(file_name)[0].split('-').pop()
+    output_path = os.path.join(tiles_path, output_path)
+    if format == 'dir':
+        output = output_path
+        staging = f'{output_path}.staging'
+        outputs = [os.path.join(output_path, tilestore.TILESET_FILE)]
+    else:
+        output = f'{output_path}.mbtiles'
+        staging = f'{output_path}.staging.mbtiles'
+        outputs = [output]
+    if format == 'pmtiles':
+        outputs.append(f'{output_path}.pmtiles')
+    source = manifest.hash(input_file)
+    rebuild = clean or not (manifest.fresh(output_path, [input_file], params, outputs)
+                            or tiler.resumable(output, source, encoding))
+    if rebuild:
+        # 上次重切中断留下的暂存切片输入相同时继续, 否则删除
+        if clean or not tiler.resumable(staging, source, encoding):
+            tilestore.remove(staging)
+        target = staging
+    else:
+        target = output
+    print(f'\n{file_name}开始切片')
+    start_time = time.time()
+    cpu = processes or os.cpu_count()
+    encoders = min(tile_encoders, cpu)
+    with measure('tiles', input_file, zoom=zoom, format=format, encoding=encoding) as m:
+        stats = tiler.cut(input_file, target, zoom, max(1, cpu // encoders),
+                          progress=progress(f'tiles {file_name}'), source=source,
+                          encoding=encoding, encoders=encoders)
+        m.update(zooms=stats, tiles=sum(z['tiles'] for z in stats.values()),
+                 bytes_written=sum(z['bytes'] for z in stats.values()),
+                 encode_seconds=sum(z['encode_seconds'] for z in stats.values()))
+    if rebuild:
+        tilestore.replace(staging, output)
+    if format == 'pmtiles' and (stats or rebuild or not os.path.exists(outputs[-1])):
+        count, unique = tilestore.convert(output, outputs[-1], encoding['format'])
+        print(f'pmtiles: {count} tiles, {unique} unique, dedup {count / max(unique, 1):.1f}x')
+    manifest.record(output_path, [input_file], params, outputs)
+    t = format_seconds(time.time() - start_time)
+    print(f"created tileset successfully: {outputs[-1] if format != 'dir' else output_path}, 耗时: {t}")
+    return output_path
+
+
+def compare_encodings(src, zoom, encodings=None):
+    '''
+    比较各瓦片编码的大小与编解码速度
+    结果保存为report_path下的encodings-时间.json, 不参与运行报告的吞吐量比较
+    :param zoom: 取样的级别
+    :param encodings: {名称: 编码选项}, 默认为tiler.ENCODINGS
+    '''
+    input_file = os.path.normpath(src)
+    own = metrics.Report()
+    result = tiler.compare_encodings(input_file, zoom, encodings)
+    for name, r in result.items():
+        with own.stage('encoding', input_file, encoding=name, zoom=zoom) as m:
+            m.update(r)
+        print(f"{name:<16} {r['bytes'] / max(r['tiles'], 1) / 1024:8.1f} KB/tile, "
+              f"encode {r['encode_ms']:.1f} ms, decode {r['decode_ms']:.1f} ms"
+              f"{'' if r['lossless'] else ', lossy!'}")
+    print(f'report: {own.save(report_path, "encodings")}')
+    return result
+
+
+def start(zoom = '0-5', max_cpu=None, max_mem=None, fused=True, native=True, stack=False, live=False):
+    '''
+    处理path_main下的全部文件
+    各文件的重投影、rgb编码、切片由调度器并行执行, 同时运行的阶段所占核数与内存之和不超过预算
+    :param zoom: 切片级别
+    :param max_cpu: 核数预算, 默认为全部核
+    :param max_mem: 内存预算(MB), None为不限制
+    :param fused: 重投影与rgb编码在进程内合并完成, 为False时调用gdalwarp与rio rgbify
+    :param native: 由tiler在进程内切片, 为False时调用gdal2tiles.py
+    :param stack: 网格相同的待处理文件叠加后一起重投影与rgb编码, 完成后再切片, 需要fused
+    :param live: 输出各阶段进度
+    运行结束后在report_path保存json报告, 并与上一次报告比较吞吐量
+    '''
+    global report
     if not os.path.exists(path_main):
         return
     if not os.path.exists(temp_path):
@@ -108,20 +368,72 @@ def start(zoom = '0-5'):
         os.makedirs(rgb_path)
     if not os.path.exists(tiles_path):
         os.makedirs(tiles_path)
+
+    def stage(name, func):
+        cpu, mem = stage_cost[name]
+        return Stage(name, func, cpu, mem)
+
+    def tile_stage():
+        if native:
+            return stage('tiles', lambda src, cpu: tiles(src, zoom, processes=cpu))
+        return stage('gdal2tiles', lambda src, cpu: gdal2tiles(src, zoom, processes=cpu) or src)
+
+    report = metrics.Report(live)
+    scheduler = Scheduler(max_cpu, max_mem)
+    start_time = time.time()
+    pending = []
     for filename in os.listdir(path_main):
         file = os.path.join(path_main, filename)
         # rgb编码文件
-        rgbtif = os.path.join(rgb_path, filename)
-        if not os.path.exists(rgbtif):
+        rgbtif = os.path.normpath(os.path.join(rgb_path, filename))
+        if manifest.fresh(rgbtif, [file], rgb_params()):
+            # 切片
+            scheduler.add(filename, rgbtif, [tile_stage()])
+        else:
+            pending.append(file)
+
+    groups = {}
+    if stack and fused:
+        for file in pending:
+            groups.setdefault(terrainrgb.grid_key(file), []).append(file)
+        groups = {k: v for k, v in groups.items() if len(v) > 1}
+    stacked = [file for files in groups.values() for file in files]
+    for i, files in enumerate(groups.values()):
+        # 叠加重投影与rgb编码, 与已有rgb文件的切片同时进行
+        scheduler.add(f'stack-{i}', files, [stage('reproject_rgbify_stack', reproject_rgbify_stack)])
+
+    for file in pending:
+        if file in stacked:
+            continue
+        filename = os.path.basename(file)
+        stages = []
+        if fused:
+            # 重投影与rgb编码
+            stages.append(stage('reproject_rgbify', lambda src, cpu: reproject_rgbify(src, cpu)))
+        else:
             # 重投影
             retif = os.path.join(temp_path, filename)
-            retif = reproject(file, retif)
-
+            stages.append(stage('reproject', lambda src, cpu, retif=retif: reproject(src, retif, cpu, stage_cost['reproject'][1])))
             # rgb编码
-            rgbtif = rgbify(retif)
+            stages.append(stage('rgbify', lambda src, cpu, file=file: rgbify(src, cpu, file)))
+        # 切片
+        stages.append(tile_stage())
+        scheduler.add(filename, file, stages)
+    results = scheduler.run()
 
-        # 切片    
-        gdal2tiles(rgbtif, zoom)
+    if groups:
+        scheduler = Scheduler(max_cpu, max_mem)
+        for i in range(len(groups)):
+            for rgbtif in results.get(f'stack-{i}') or []:
+                scheduler.add(os.path.basename(rgbtif), rgbtif, [tile_stage()])
+        scheduler.run()
+    previous = metrics.latest(report_path)
+    path = report.save(report_path)
+    if previous:
+        for name, file, metric, old, new in metrics.compare(previous, report.to_dict()):
+            print(f'吞吐量下降: {name} {file} {metric}: {old:.1f}/s -> {new:.1f}/s')
+    t = format_seconds(time.time() - start_time)
+    print(f"all done, 耗时: {t}, 报告: {path}")
 
 
 if __name__ == '__main__':
@@ -129,6 +441,7 @@ if __name__ == '__main__':
     # rgbtif = rgbify('./tif_3857/landscan-global-2000.tif')
     # gdal2tiles(rgbtif, '0-5')
     start('8-9')
+    # compare_encodings('G:/raster/tif_rgb/landscan-global-2022.tif', 8)
     # gdal2tiles('G:/raster/tif_rgb/landscan-global-2022.tif', '0-5')
 
 
@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+import threading
+
+
+def file_hash(path, chunk=8 * 1024 * 1024):
+    '''
+    计算文件内容的哈希
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class Manifest:
+    '''
+    构建清单, 记录每个产物的输入哈希、参数与输出哈希
+    产物只有在输入、参数都未变化且输出与记录一致时才跳过
+    文件哈希按(大小, 修改时间)缓存, 未变化的大文件不会重复计算
+    :param path: 清单文件路径
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.data = {'hashes': {}, 'stages': {}}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.data = json.load(f)
+
+    def hash(self, path):
+        '''
+        文件哈希, 文件不存在时返回None
+        '''
+        path = os.path.normpath(path)
+        if not os.path.isfile(path):
+            return None
+        stat = os.stat(path)
+        with self.lock:
+            cached = self.data['hashes'].get(path)
+        if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+            return cached['hash']
+        value = file_hash(path)
+        with self.lock:
+            self.data['hashes'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': value}
+        return value
+
+    def get(self, key):
+        with self.lock:
+            return self.data['stages'].get(os.path.normpath(key))
+
+    def fresh(self, key, inputs, params, outputs=None):
+        '''
+        产物是否为最新
+        :param key: 产物名称, 一般为输出路径
+        :param inputs: 输入文件列表
+        :param params: 参数, 需可json序列化
+        :param outputs: 输出文件列表, 默认为[key]
+        '''
+        record = self.get(key)
+        if record is None or record['params'] != json.loads(json.dumps(params)):
+            return False
+        if sorted(record['inputs']) != sorted(os.path.normpath(p) for p in inputs):
+            return False
+        for path, value in record['inputs'].items():
+            if self.hash(path) != value:
+                return False
+        for path in outputs if outputs is not None else [key]:
+            value = self.hash(path)
+            if value is None or record['outputs'].get(os.path.normpath(path)) != value:
+                return False
+        return True
+
+    def record(self, key, inputs, params, outputs=None):
+        '''
+        阶段成功后记录产物
+        '''
+        record = {
+            'inputs': {os.path.normpath(p): self.hash(p) for p in inputs},
+            'params': json.loads(json.dumps(params)),
+            'outputs': {os.path.normpath(p): self.hash(p) for p in (outputs if outputs is not None else [key])},
+        }
+        with self.lock:
+            self.data['stages'][os.path.normpath(key)] = record
+        self.save()
+
+    def forget(self, key):
+        with self.lock:
+            self.data['stages'].pop(os.path.normpath(key), None)
+        self.save()
+
+    def save(self):
+        with self.lock:
+            text = json.dumps(self.data, indent=2, ensure_ascii=False)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # 先写临时文件再替换, 中途崩溃不会损坏清单
+            tmp = f'{self.path}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp, self.path)
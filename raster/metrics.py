@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def rss():
+    '''
+    当前进程及全部子进程(gdalwarp、切片进程池等)的内存占用(字节)
+    没有安装psutil时返回None
+    '''
+    if psutil is None:
+        return None
+    process = psutil.Process()
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            total += child.memory_info().rss
+        except psutil.Error:
+            pass
+    return total
+
+
+def cpu_seconds():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class Report:
+    '''
+    一次运行的指标, 记录各阶段的耗时、读写字节数、像素数、瓦片数与内存峰值, 保存为json
+    内存按进程树定时采样, 同时运行的阶段看到的是整体峰值
+    :param live: 是否输出进度
+    :param interval: 内存采样间隔(秒)
+    '''
+    def __init__(self, live=False, interval=0.5):
+        self.live = live
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stages = []
+        self.active = []
+        self.started = datetime.datetime.now()
+        self.start_time = time.time()
+        self.start_cpu = cpu_seconds()
+        self.peak_rss = None
+        self.stopped = threading.Event()
+        if psutil is not None:
+            threading.Thread(target=self._sample, daemon=True).start()
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            value = rss()
+            with self.lock:
+                self.peak_rss = max(self.peak_rss or 0, value)
+                for record in self.active:
+                    record['peak_rss'] = max(record['peak_rss'] or 0, value)
+
+    @contextmanager
+    def stage(self, name, file=None, **info):
+        '''
+        记录一个阶段, 阶段内可向返回的dict补充bytes_read、bytes_written、pixels、tiles等字段
+        '''
+        record = {
+            'stage': name,
+            'file': os.path.basename(file) if file else None,
+            'started': datetime.datetime.now().isoformat(timespec='seconds'),
+            'seconds': None,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'pixels': 0,
+            'peak_rss': rss(),
+            **info,
+        }
+        with self.lock:
+            self.active.append(record)
+        start_time = time.time()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            seconds = time.time() - start_time
+            record['seconds'] = seconds
+            if record['pixels']:
+                record['pixels_per_s'] = record['pixels'] / max(seconds, 1e-6)
+            if record['bytes_read']:
+                record['read_mb_per_s'] = record['bytes_read'] / 1048576 / max(seconds, 1e-6)
+            if record['bytes_written']:
+                record['write_mb_per_s'] = record['bytes_written'] / 1048576 / max(seconds, 1e-6)
+            with self.lock:
+                self.active.remove(record)
+                self.stages.append(record)
+
+    def progress(self, label, every=5):
+        '''
+        进度回调, callback(done, total, prefix=''), 每every秒最多输出一次
+        live为False时返回None
+        '''
+        if not self.live:
+            return None
+        last = [0.0]
+
+        def callback(done, total, prefix=''):
+            now = time.time()
+            if done < total and now - last[0] < every:
+                return
+            last[0] = now
+            print(f'{label}{prefix}: {done}/{total} ({done * 100 / max(total, 1):.0f}%)')
+        return callback
+
+    def to_dict(self):
+        with self.lock:
+            stages = list(self.stages)
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'seconds': time.time() - self.start_time,
+            'cpu_seconds': cpu_seconds() - self.start_cpu,
+            'peak_rss': self.peak_rss,
+            'stages': stages,
+        }
+
+    def save(self, report_dir, prefix='run'):
+        '''
+        保存为{report_dir}/{prefix}-时间.json
+        :param prefix: 文件名前缀, latest只查找run开头的报告
+        :return: 文件路径
+        '''
+        self.stopped.set()
+        os.makedirs(report_dir, exist_ok=True)
+        path = os.path.join(report_dir, f'{prefix}-{self.started:%Y%m%d-%H%M%S}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+        return path
+
+
+def rates(report):
+    '''
+    各(阶段, 文件)的吞吐量, 切片按级别计算瓦片/秒, 其他按像素/秒
+    '''
+    result = {}
+    for record in report['stages']:
+        if record.get('error'):
+            continue
+        for z, zoom in (record.get('zooms') or {}).items():
+            if zoom['tiles']:
+                result[(record['stage'], record['file'], f'zoom {z}')] = zoom['tiles'] / max(zoom['seconds'], 1e-6)
+        if record.get('pixels_per_s'):
+            result[(record['stage'], record['file'], 'pixels')] = record['pixels_per_s']
+    return result
+
+
+def compare(previous, current, threshold=0.2):
+    '''
+    与上一次运行比较吞吐量, 返回下降超过threshold的项
+    :param previous: 上一次的报告文件路径
+    :param current: 本次的报告dict
+    :return: [(阶段, 文件, 指标, 上次, 本次)]
+    '''
+    with open(previous, 'r', encoding='utf-8') as f:
+        old = rates(json.load(f))
+    new = rates(current)
+    return [(*key, old[key], value) for key, value in new.items()
+            if key in old and value < old[key] * (1 - threshold)]
+
+
+def latest(report_dir):
+    '''
+    最近一次的报告文件, 没有时返回None
+    '''
+    if not os.path.isdir(report_dir):
+        return None
+    names = sorted(n for n in os.listdir(report_dir) if n.startswith('run-') and n.endswith('.json'))
+    return os.path.join(report_dir, names[-1]) if names else None
@@ -0,0 +1,124 @@
+import os
+import threading
+import traceback
+
+
+class Stage:
+    '''
+    流水线中的一个阶段
+    :param name: 阶段名称
+    :param func: 执行函数, func(value, cpu) -> value, 上一阶段的返回值作为下一阶段的输入, 返回None则作业结束
+    :param cpu: 占用的核数
+    :param mem: 占用的内存(MB)
+    '''
+    def __init__(self, name, func, cpu=1, mem=0):
+        self.name = name
+        self.func = func
+        self.cpu = cpu
+        self.mem = mem
+
+
+class Job:
+    def __init__(self, name, value, stages, index):
+        self.name = name
+        self.value = value
+        self.stages = stages
+        self.index = index
+        self.step = 0
+        self.error = None
+
+    @property
+    def stage(self):
+        return self.stages[self.step]
+
+    def priority(self):
+        # 越靠后的阶段越优先, 让已开始的作业尽快完成并释放中间文件
+        return (-self.step, self.index)
+
+
+class Scheduler:
+    '''
+    多文件分阶段调度器
+    不同文件的不同阶段可以同时运行(如第N+1年重投影时第N年在切片),
+    同时运行的阶段所占核数与内存之和不超过预算
+    :param max_cpu: 核数预算, 默认为全部核
+    :param max_mem: 内存预算(MB), None为不限制
+    '''
+    def __init__(self, max_cpu=None, max_mem=None):
+        self.max_cpu = max_cpu or os.cpu_count() or 1
+        self.max_mem = max_mem
+        self.jobs = []
+
+    def add(self, name, value, stages):
+        '''
+        添加作业
+        :param name: 作业名称
+        :param value: 第一个阶段的输入
+        :param stages: Stage列表, 按顺序执行
+        '''
+        stages = [s for s in stages if s is not None]
+        if stages:
+            self.jobs.append(Job(name, value, stages, len(self.jobs)))
+
+    def _cost(self, stage):
+        cpu = min(stage.cpu, self.max_cpu)
+        mem = stage.mem
+        if self.max_mem is not None:
+            mem = min(mem, self.max_mem)
+        return cpu, mem
+
+    def run(self):
+        '''
+        运行全部作业
+        :return: {作业名称: 最后一个阶段的返回值}, 失败的作业不在其中
+        '''
+        cond = threading.Condition()
+        ready = list(self.jobs)
+        state = {'cpu': 0, 'mem': 0, 'running': 0}
+        results = {}
+
+        def fits(cpu, mem):
+            if state['cpu'] + cpu > self.max_cpu:
+                return False
+            if self.max_mem is not None and state['mem'] + mem > self.max_mem:
+                return False
+            return True
+
+        def work(job, cpu, mem):
+            stage = job.stage
+            value = None
+            try:
+                value = stage.func(job.value, cpu)
+            except Exception as e:
+                job.error = e
+                print(f'{job.name} {stage.name} 失败: {e}')
+                traceback.print_exc()
+            with cond:
+                state['cpu'] -= cpu
+                state['mem'] -= mem
+                state['running'] -= 1
+                if job.error is None:
+                    job.value = value
+                    job.step += 1
+                    if value is None or job.step >= len(job.stages):
+                        results[job.name] = value
+                    else:
+                        ready.append(job)
+                cond.notify_all()
+
+        with cond:
+            while ready or state['running']:
+                started = False
+                for job in sorted(ready, key=Job.priority):
+                    cpu, mem = self._cost(job.stage)
+                    if not fits(cpu, mem):
+                        continue
+                    ready.remove(job)
+                    state['cpu'] += cpu
+                    state['mem'] += mem
+                    state['running'] += 1
+                    threading.Thread(target=work, args=(job, cpu, mem), daemon=True).start()
+                    started = True
+                if not started:
+                    cond.wait()
+        return results
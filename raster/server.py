@@ -0,0 +1,247 @@
+'''
+切片服务
+/{year}/{z}/{x}/{y}返回tiles_path下{year}目录、{year}.pmtiles或{year}.mbtiles中的瓦片
+/{year}/tiles.json返回TileJSON
+
+目录中的瓦片以FileResponse直接发送文件, ASGI服务器支持http.response.pathsend时(如granian)由服务器零拷贝发送
+单文件中的瓦片与按需生成的瓦片缓存在内存LRU中
+响应带ETag与Cache-Control, If-None-Match命中时返回304
+有数据的级别以外的低级别瓦片可由子瓦片按需生成
+
+python server.py 0.0.0.0 8080
+'''
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
+
+import main
+import tiler
+import tilestore
+
+# 内存缓存大小(字节)
+cache_size = 256 * 1024 * 1024
+
+# 浏览器与CDN的缓存时间(秒), 切片重建后ETag会变化
+max_age = 86400
+
+# 是否按需生成低级别瓦片, 以及最多向下几级读取子瓦片
+generate = True
+
+max_depth = 3
+
+MEDIA_TYPES = {'png': 'image/png', 'webp': 'image/webp', 'jpg': 'image/jpeg'}
+
+app = FastAPI()
+
+# 允许跨域请求
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_methods=["GET", "HEAD"],
+    allow_headers=["*"],
+    expose_headers=["ETag"],
+)
+
+
+class LRU:
+    '''
+    按字节数限制大小的LRU缓存, 可多线程访问
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        # value为(瓦片字节或None, etag)
+        size = len(value[0] or b'') + 128
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0] or b'') + 128
+            self.items[key] = value
+            self.size += size
+            while self.size > self.max_bytes and self.items:
+                _, old = self.items.popitem(last=False)
+                self.size -= len(old[0] or b'') + 128
+
+
+cache = LRU(cache_size)
+
+
+class Tileset:
+    '''
+    一个年份的切片
+    :param path: 目录或单文件
+    :param version: 打开时文件(目录为tiles.json)的修改时间, 变化后重新打开
+    '''
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        info = tiler.load_info(path) or {'tilesize': tiler.TILE_SIZE, 'zooms': []}
+        self.tilesize = info['tilesize']
+        self.zooms = set(info['zooms'])
+        self.encoding = info.get('encoding', tiler.DEFAULT_ENCODING)
+        self.store = tilestore.open_store(path, 'r', self.encoding['format'])
+        self.directory = isinstance(self.store, tilestore.DirectoryStore)
+        if isinstance(self.store, tilestore.PMTilesStore):
+            self.encoding = {'format': self.store.ext}
+        self.ext = self.encoding['format']
+        self.media_type = MEDIA_TYPES.get(self.ext, 'application/octet-stream')
+        # MBTiles连接与PMTiles文件不能同时被多个线程读取
+        self.lock = threading.Lock()
+
+    def read(self, z, x, y):
+        if self.directory:
+            return self.store.get(z, x, y)
+        with self.lock:
+            return self.store.get(z, x, y)
+
+    def close(self):
+        with self.lock:
+            self.store.close()
+
+
+tilesets = {}
+
+tilesets_lock = threading.Lock()
+
+
+def locate(year):
+    '''
+    年份对应的切片及其版本, 依次查找目录、pmtiles、mbtiles
+    :return: (路径, 版本), 不存在时返回(None, None)
+    '''
+    base = os.path.join(main.tiles_path, year)
+    for path, marker in ((base, os.path.join(base, tilestore.TILESET_FILE)),
+                         (f'{base}.pmtiles', f'{base}.pmtiles'),
+                         (f'{base}.mbtiles', f'{base}.mbtiles')):
+        try:
+            return path, os.stat(marker).st_mtime_ns
+        except OSError:
+            continue
+    return None, None
+
+
+def tileset(year):
+    '''
+    打开的切片, 切片重建后重新打开
+    '''
+    if not year.isdigit():
+        return None
+    path, version = locate(year)
+    if path is None:
+        return None
+    with tilesets_lock:
+        current = tilesets.get(year)
+        if current is not None and current.path == path and current.version == version:
+            return current
+        tilesets[year] = Tileset(path, version)
+    if current is not None:
+        current.close()
+    return tilesets[year]
+
+
+def fetch(year, ts, z, x, y, depth=0):
+    '''
+    读取单文件中的瓦片, 或由子瓦片生成低级别瓦片, 结果写入缓存
+    :return: (瓦片字节或None, etag)
+    '''
+    key = (year, ts.version, z, x, y)
+    value = cache.get(key)
+    if value is not None:
+        return value
+    data = None
+    if z in ts.zooms:
+        data = ts.read(z, x, y)
+    elif generate and ts.zooms and z < min(ts.zooms) and depth < max_depth:
+        tile = tiler.derive_tile(lambda *c: fetch(year, ts, *c, depth + 1)[0], z, x, y, ts.tilesize)
+        if tile is not None:
+            data = tiler.encode_tile(tile, **ts.encoding)
+    value = (data, f'"{tilestore.tile_hash(data)}"' if data else None)
+    cache.put(key, value)
+    return value
+
+
+def cache_headers(etag):
+    headers = {'Cache-Control': f'public, max-age={max_age}'}
+    if etag:
+        headers['ETag'] = etag
+    return headers
+
+
+def not_modified(request, etag):
+    match = request.headers.get('if-none-match')
+    return etag is not None and match is not None and \
+        (match.strip() == '*' or etag in [m.strip().removeprefix('W/') for m in match.split(',')])
+
+
+@app.get('/{year}/tiles.json')
+async def tilejson(year: str, request: Request):
+    ts = await run_in_threadpool(tileset, year)
+    if ts is None or not ts.zooms:
+        return Response(status_code=404)
+    minzoom = max(0, min(ts.zooms) - max_depth) if generate else min(ts.zooms)
+    return {
+        'tilejson': '3.0.0',
+        'name': year,
+        'tiles': [f'{str(request.base_url).rstrip("/")}/{year}/{{z}}/{{x}}/{{y}}.{ts.ext}'],
+        'minzoom': minzoom,
+        'maxzoom': max(ts.zooms),
+        'tileSize': ts.tilesize,
+        'encoding': 'mapbox',
+    }
+
+
+@app.get('/{year}/{z}/{x}/{y}')
+async def tile(year: str, z: int, x: int, y: str, request: Request):
+    y = y.split('.')[0]
+    if not y.isdigit() or not 0 <= z <= 30 or not 0 <= x < 1 << z or not int(y) < 1 << z:
+        return Response(status_code=404)
+    y = int(y)
+    ts = await run_in_threadpool(tileset, year)
+    if ts is None:
+        return Response(status_code=404)
+    if ts.directory and z in ts.zooms:
+        path = ts.store.tile_path(z, x, y)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # 全部为无数据的瓦片不输出
+            return Response(status_code=204, headers=cache_headers(None))
+        etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+        if not_modified(request, etag):
+            return Response(status_code=304, headers=cache_headers(etag))
+        return FileResponse(path, media_type=ts.media_type, headers=cache_headers(etag), stat_result=stat)
+    value = cache.get((year, ts.version, z, x, y))
+    if value is None:
+        value = await run_in_threadpool(fetch, year, ts, z, x, y)
+    data, etag = value
+    if data is None:
+        return Response(status_code=204, headers=cache_headers(None))
+    if not_modified(request, etag):
+        return Response(status_code=304, headers=cache_headers(etag))
+    return Response(data, media_type=ts.media_type, headers=cache_headers(etag))
+
+
+def serve(host='0.0.0.0', port=8080):
+    uvicorn.run(app, host=host, port=port)
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1] if len(sys.argv) > 1 else '0.0.0.0', int(sys.argv[2]) if len(sys.argv) > 2 else 8080)
@@ -0,0 +1,277 @@
+import os
+import tempfile
+import threading
+from xml.sax.saxutils import escape
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform as transform_coords
+from rasterio.windows import Window
+
+
+def encode(data, base=0, interval=0.01):
+    '''
+    Terrain-RGB编码, 算法与rio rgbify -b base -i interval一致
+    :param data: 二维数组
+    :return: (3, h, w)的uint8数组
+    '''
+    data = (data.astype('float64') - base) / interval
+    if data.size and data.max() - data.min() >= 256 ** 3:
+        raise ValueError(f'Data of {data.max() - data.min()} larger than 256 ** 3')
+    rgb = np.empty((3,) + data.shape, dtype='uint8')
+    rgb[2] = ((data / 256) - (data // 256)) * 256
+    rgb[1] = (((data // 256) / 256) - ((data // 256) // 256)) * 256
+    rgb[0] = ((((data // 256) // 256) / 256) - (((data // 256) // 256) // 256)) * 256
+    return rgb
+
+
+def target_grid(bounds, res):
+    '''
+    由-te/-tr计算目标栅格
+    :param bounds: (xmin, ymin, xmax, ymax)
+    :param res: (xres, yres)
+    :return: (transform, width, height)
+    '''
+    xmin, ymin, xmax, ymax = bounds
+    width = int(round((xmax - xmin) / res[0]))
+    height = int(round((ymax - ymin) / res[1]))
+    return from_origin(xmin, ymax, res[0], res[1]), width, height
+
+
+def rgb_profile(transform, width, height, blocksize=512):
+    return {
+        'driver': 'GTiff',
+        'dtype': 'uint8',
+        'count': 3,
+        'crs': 'EPSG:3857',
+        'transform': transform,
+        'width': width,
+        'height': height,
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+        'compress': 'DEFLATE',
+        'BIGTIFF': 'IF_NEEDED',
+    }
+
+
+# rasterio数据类型对应的GDAL类型名
+GDAL_TYPES = {
+    'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32',
+    'int32': 'Int32', 'float32': 'Float32', 'float64': 'Float64',
+}
+
+
+def grid_key(input_file):
+    '''
+    源文件的网格, 网格相同的文件可以叠加后一起重投影
+    '''
+    with rasterio.open(input_file) as src:
+        return (src.crs.to_wkt() if src.crs else None, tuple(src.transform), src.width, src.height,
+                src.dtypes[0], src.nodata)
+
+
+def stack_vrt(input_files, vrt_file):
+    '''
+    将网格相同的多个单波段文件叠加为一个多波段VRT, 第i个波段为第i个文件
+    '''
+    key = grid_key(input_files[0])
+    for path in input_files[1:]:
+        if grid_key(path) != key:
+            raise ValueError(f'{path}与{input_files[0]}的网格不同, 不能叠加')
+    crs, transform, width, height, dtype, nodata = key
+    a, b, c, d, e, f = transform[:6]
+    bands = []
+    for i, path in enumerate(input_files):
+        band = f'<VRTRasterBand dataType="{GDAL_TYPES[dtype]}" band="{i + 1}">'
+        if nodata is not None:
+            band += f'<NoDataValue>{nodata!r}</NoDataValue>'
+        band += (f'<SimpleSource><SourceFilename relativeToVRT="0">{escape(os.path.abspath(path))}</SourceFilename>'
+                 f'<SourceBand>1</SourceBand></SimpleSource></VRTRasterBand>')
+        bands.append(band)
+    srs = f'<SRS>{escape(crs)}</SRS>' if crs else ''
+    with open(vrt_file, 'w', encoding='utf-8') as out:
+        out.write(f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">{srs}'
+                  f'<GeoTransform>{c!r}, {a!r}, {b!r}, {f!r}, {d!r}, {e!r}</GeoTransform>'
+                  f'{"".join(bands)}</VRTDataset>')
+    return vrt_file
+
+
+def center_pixels(src, transform, window):
+    '''
+    目标块内每个像素中心所在的源像素行列号, 所有波段共用
+    源为经纬度时经度只与列有关、纬度只与行有关, 只需变换一行一列
+    :return: (rows, cols), 超出源范围的为-1
+    '''
+    h, w = int(window.height), int(window.width)
+    cols = np.arange(w) + window.col_off + 0.5
+    rows = np.arange(h) + window.row_off + 0.5
+    if src.crs.is_geographic:
+        xs, _ = transform * (cols, np.full(w, rows[0]))
+        _, ys = transform * (np.full(h, cols[0]), rows)
+        lon, _ = transform_coords('EPSG:3857', src.crs, xs, np.zeros(w))
+        _, lat = transform_coords('EPSG:3857', src.crs, np.zeros(h), ys)
+        lon, lat = np.meshgrid(lon, lat)
+    else:
+        cc, rr = np.meshgrid(cols, rows)
+        xs, ys = transform * (cc.ravel(), rr.ravel())
+        lon, lat = transform_coords('EPSG:3857', src.crs, xs, ys)
+        lon, lat = np.asarray(lon).reshape(h, w), np.asarray(lat).reshape(h, w)
+    c, r = ~src.transform * (np.asarray(lon), np.asarray(lat))
+    c = np.floor(c).astype('int64')
+    r = np.floor(r).astype('int64')
+    outside = (c < 0) | (c >= src.width) | (r < 0) | (r >= src.height)
+    c[outside] = -1
+    r[outside] = -1
+    return r, c
+
+
+def mask_centers(src, data, rows, cols):
+    '''
+    中心所在源像素为无数据的目标像素置0
+    单波段重投影时GDAL即如此处理, 多波段各自的无数据值需要单独处理
+    '''
+    inside = rows >= 0
+    if src.nodata is None or not inside.any():
+        data[:, ~inside] = 0
+        return data
+    r0, r1 = rows[inside].min(), rows[inside].max() + 1
+    c0, c1 = cols[inside].min(), cols[inside].max() + 1
+    values = src.read(window=Window(c0, r0, c1 - c0, r1 - r0))
+    center = values[:, np.where(inside, rows - r0, 0), np.where(inside, cols - c0, 0)]
+    data[(center == src.nodata) | ~inside] = 0
+    return data
+
+
+def strips(width, height, rows):
+    for row in range(0, height, rows):
+        yield Window(0, row, width, min(rows, height - row))
+
+
+def reproject_rgbify(input_file, output_file, bounds, res, base=0, interval=0.01, workers=1, rows=512,
+                     progress=None):
+    '''
+    重投影到EPSG:3857并rgb编码, 逐块在内存中完成, 不生成中间文件
+    与gdalwarp -r bilinear -dstnodata None + rio rgbify的结果一致
+    :param bounds: 目标范围, 同gdalwarp -te
+    :param res: 目标分辨率, 同gdalwarp -tr
+    :param base: 同rio rgbify -b
+    :param interval: 同rio rgbify -i
+    :param workers: 读取与编码的线程数
+    :param rows: 每块的行数
+    :param progress: 进度回调, progress(已写出行数, 总行数)
+    '''
+    transform, width, height = target_grid(bounds, res)
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def vrt():
+        # 每个线程单独打开数据集, GDAL句柄不能跨线程共享
+        if not hasattr(local, 'vrt'):
+            src = rasterio.open(input_file)
+            local.vrt = WarpedVRT(src, crs='EPSG:3857', transform=transform, width=width, height=height,
+                                  resampling=Resampling.bilinear, src_nodata=src.nodata, nodata=0)
+            with lock:
+                handles.append((local.vrt, src))
+        return local.vrt
+
+    def work(window):
+        return window, encode(vrt().read(1, window=window), base, interval)
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    try:
+        with rasterio.open(output_file, 'w', **rgb_profile(transform, width, height)) as dst, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for window in strips(width, height, rows):
+                pending.append(executor.submit(work, window))
+                # 限制在途的块数, 避免写入慢于读取时内存上涨
+                if len(pending) >= workers * 2:
+                    done, rgb = pending.pop(0).result()
+                    dst.write(rgb, window=done)
+                    if progress:
+                        progress(done.row_off + done.height, height)
+            for future in pending:
+                done, rgb = future.result()
+                dst.write(rgb, window=done)
+                if progress:
+                    progress(done.row_off + done.height, height)
+    finally:
+        for v, src in handles:
+            v.close()
+            src.close()
+    return output_file
+
+
+def stack_reproject_rgbify(input_files, output_files, bounds, res, base=0, interval=0.01, workers=1, rows=None,
+                           progress=None):
+    '''
+    多个网格相同的文件(如各年份的landscan)叠加为多波段后一起重投影并rgb编码
+    GDAL对每个块只计算一次坐标变换并用于所有波段, 各文件共用同一组读取窗口
+    结果与逐个调用reproject_rgbify一致
+    :param input_files: 源文件列表
+    :param output_files: 对应的输出文件列表
+    :param rows: 每块的行数, 默认按文件数缩小以限制内存
+    :param progress: 进度回调, progress(已写出行数, 总行数)
+    '''
+    if len(input_files) != len(output_files):
+        raise ValueError('input_files与output_files数量不同')
+    transform, width, height = target_grid(bounds, res)
+    rows = rows or max(64, 512 // len(input_files))
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+    fd, vrt_file = tempfile.mkstemp(suffix='.vrt')
+    os.close(fd)
+    stack_vrt(input_files, vrt_file)
+
+    def vrt():
+        if not hasattr(local, 'vrt'):
+            local.src = rasterio.open(vrt_file)
+            # 各波段的无数据值相互独立
+            local.vrt = WarpedVRT(local.src, crs='EPSG:3857', transform=transform, width=width, height=height,
+                                  resampling=Resampling.bilinear, src_nodata=local.src.nodata, nodata=0,
+                                  UNIFIED_SRC_NODATA='NO')
+            with lock:
+                handles.append((local.vrt, local.src))
+        return local.vrt
+
+    def work(window):
+        data = vrt().read(window=window)
+        data = mask_centers(local.src, data, *center_pixels(local.src, transform, window))
+        return window, [encode(band, base, interval) for band in data]
+
+    outputs = []
+    try:
+        for path in output_files:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            outputs.append(rasterio.open(path, 'w', **rgb_profile(transform, width, height)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = []
+
+            def write(future):
+                done, rgbs = future.result()
+                for dst, rgb in zip(outputs, rgbs):
+                    dst.write(rgb, window=done)
+                if progress:
+                    progress(done.row_off + done.height, height)
+
+            for window in strips(width, height, rows):
+                pending.append(executor.submit(work, window))
+                if len(pending) >= workers * 2:
+                    write(pending.pop(0))
+            for future in pending:
+                write(future)
+    finally:
+        for dst in outputs:
+            dst.close()
+        for v, src in handles:
+            v.close()
+            src.close()
+        os.remove(vrt_file)
+    return output_files
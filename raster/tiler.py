@@ -0,0 +1,497 @@
+import os
+import io
+import math
+import time
+import zlib
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import numpy as np
+import rasterio
+from PIL import Image
+from rasterio.enums import MaskFlags, Resampling
+from rasterio.windows import from_bounds
+
+from tilestore import open_store
+
+# EPSG:3857的半周长
+ORIGIN = 20037508.342789244
+
+TILE_SIZE = 512
+
+# 瓦片编码选项, 均为无损
+# format: png或webp
+# level: png的zlib压缩级别(0-9)
+# filter: png行过滤, none/sub/up/average/paeth/adaptive, None时由Pillow选择
+# strategy: png的zlib压缩策略, filtered/huffman/rle/fixed, None为默认
+# method: webp的压缩方法(0-6), 越大越慢越小
+ENCODINGS = {
+    'png': {'format': 'png'},
+    'png-fast': {'format': 'png', 'level': 1},
+    'png-up-9': {'format': 'png', 'level': 9, 'filter': 'up'},
+    'png-paeth-rle': {'format': 'png', 'filter': 'paeth', 'strategy': 'rle'},
+    'webp': {'format': 'webp'},
+    'webp-fast': {'format': 'webp', 'method': 0},
+}
+
+DEFAULT_ENCODING = ENCODINGS['png']
+
+PNG_FILTERS = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4}
+
+ZLIB_STRATEGIES = {
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': zlib.Z_RLE,
+    'fixed': zlib.Z_FIXED,
+}
+
+
+def parse_zoom(zoom):
+    '''
+    解析切片级别, 如'8-9'或'5'
+    :return: (最小级别, 最大级别)
+    '''
+    if isinstance(zoom, int):
+        return zoom, zoom
+    parts = str(zoom).split('-')
+    return int(parts[0]), int(parts[-1])
+
+
+def tile_extent(z):
+    '''
+    z级瓦片的边长(米)
+    '''
+    return 2 * ORIGIN / 2 ** z
+
+
+def tile_range(bounds, z):
+    '''
+    与范围相交的瓦片行列号
+    :param bounds: EPSG:3857下的(xmin, ymin, xmax, ymax)
+    :return: (x0, y0, x1, y1), 包含两端
+    '''
+    size = tile_extent(z)
+    n = 2 ** z
+    xmin, ymin, xmax, ymax = bounds
+    x0 = max(0, int(math.floor((xmin + ORIGIN) / size)))
+    x1 = min(n - 1, int(math.ceil((xmax + ORIGIN) / size)) - 1)
+    y0 = max(0, int(math.floor((ORIGIN - ymax) / size)))
+    y1 = min(n - 1, int(math.ceil((ORIGIN - ymin) / size)) - 1)
+    return x0, y0, x1, y1
+
+
+def metatiles(bounds, z, meta):
+    '''
+    按meta x meta个瓦片分组, 逐行排列, 与检查点按行记录一致
+    :return: [(z, x, y, nx, ny)], x、y为左上角瓦片
+    '''
+    x0, y0, x1, y1 = tile_range(bounds, z)
+    return [(z, x, y, min(meta, x1 - x + 1), min(meta, y1 - y + 1))
+            for y in range(y0, y1 + 1, meta)
+            for x in range(x0, x1 + 1, meta)]
+
+
+def read_metatile(src, z, x, y, nx, ny, tilesize=TILE_SIZE):
+    '''
+    一次读取整个元瓦片范围的数据, 最邻近重采样
+    :return: (4, ny * tilesize, nx * tilesize)的RGBA数组, 与栅格不相交时返回None
+    '''
+    size = tile_extent(z)
+    res = size / tilesize
+    left = -ORIGIN + x * size
+    top = ORIGIN - y * size
+    width = nx * tilesize
+    height = ny * tilesize
+    sl, sb, sr, st = src.bounds
+    # 像素中心落在栅格范围内的行列
+    c0 = max(0, math.ceil((sl - left) / res - 0.5))
+    c1 = min(width, math.ceil((sr - left) / res - 0.5))
+    r0 = max(0, math.ceil((top - st) / res - 0.5))
+    r1 = min(height, math.ceil((top - sb) / res - 0.5))
+    if c0 >= c1 or r0 >= r1:
+        return None
+    window = from_bounds(left + c0 * res, top - r1 * res, left + c1 * res, top - r0 * res, src.transform)
+    boundless = (window.col_off < 0 or window.row_off < 0 or
+                 window.col_off + window.width > src.width or
+                 window.row_off + window.height > src.height)
+    shape = (r1 - r0, c1 - c0)
+    rgba = np.zeros((4, height, width), dtype='uint8')
+    rgba[:3, r0:r1, c0:c1] = src.read([1, 2, 3], window=window, out_shape=(3,) + shape,
+                                      resampling=Resampling.nearest, boundless=boundless)
+    if all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums):
+        rgba[3, r0:r1, c0:c1] = 255
+    else:
+        rgba[3, r0:r1, c0:c1] = src.read_masks(1, window=window, out_shape=shape,
+                                               resampling=Resampling.nearest, boundless=boundless)
+    return rgba
+
+
+def png_filter(rows, kind, bpp):
+    '''
+    PNG行过滤, 按字节取模256相减
+    :param rows: (h, w * bpp)的uint8数组
+    :return: 过滤后的数组, 与rows形状相同
+    '''
+    a = np.zeros_like(rows)
+    a[:, bpp:] = rows[:, :-bpp]
+    b = np.zeros_like(rows)
+    b[1:] = rows[:-1]
+    if kind == 'none':
+        return rows
+    if kind == 'sub':
+        return rows - a
+    if kind == 'up':
+        return rows - b
+    if kind == 'average':
+        return rows - ((a.astype('uint16') + b) >> 1).astype('uint8')
+    c = np.zeros_like(rows)
+    c[1:, bpp:] = rows[:-1, :-bpp]
+    a16, b16, c16 = a.astype('int16'), b.astype('int16'), c.astype('int16')
+    pa = np.abs(b16 - c16)
+    pb = np.abs(a16 - c16)
+    pc = np.abs(a16 + b16 - 2 * c16)
+    predictor = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    return rows - predictor
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def encode_png(pixels, level=6, filter='up', strategy=None):
+    '''
+    以指定的行过滤与zlib策略编码png
+    :param pixels: (h, w, 3)或(h, w, 4)的uint8数组
+    :param filter: 行过滤, adaptive为逐行选择绝对值之和最小的过滤
+    '''
+    height, width, bpp = pixels.shape
+    rows = np.ascontiguousarray(pixels).reshape(height, width * bpp)
+    if filter == 'adaptive':
+        candidates = [png_filter(rows, kind, bpp) for kind in PNG_FILTERS]
+        # 按有符号字节计算, 与libpng的启发式一致
+        costs = np.stack([np.abs(f.view('int8').astype('int32')).sum(axis=1) for f in candidates])
+        types = costs.argmin(axis=0).astype('uint8')
+        filtered = np.stack(candidates)[types, np.arange(height)]
+    else:
+        types = np.full(height, PNG_FILTERS[filter], dtype='uint8')
+        filtered = png_filter(rows, filter, bpp)
+    raw = np.concatenate([types[:, None], filtered], axis=1).tobytes()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 15, 9, ZLIB_STRATEGIES.get(strategy, zlib.Z_DEFAULT_STRATEGY))
+    idat = compressor.compress(raw) + compressor.flush()
+    # 8位, RGB为2, RGBA为6
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2 if bpp == 3 else 6, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', ihdr) + png_chunk(b'IDAT', idat) + png_chunk(b'IEND', b'')
+
+
+def encode_tile(data, format='png', level=6, filter=None, strategy=None, method=4):
+    '''
+    编码瓦片, 完全不透明时只保存RGB, 选项见ENCODINGS
+    :param data: (4, h, w)的RGBA数组
+    :return: png或webp字节
+    '''
+    if data[3].all():
+        data = data[:3]
+    pixels = np.ascontiguousarray(np.moveaxis(data, 0, -1))
+    if format == 'png' and filter is not None:
+        return encode_png(pixels, level, filter, strategy)
+    image = Image.fromarray(pixels)
+    buf = io.BytesIO()
+    if format == 'webp':
+        # exact保留透明像素的RGB, 与png一致
+        image.save(buf, format='WEBP', lossless=True, method=method, exact=True)
+    else:
+        image.save(buf, format='PNG', compress_level=level,
+                   compress_type=ZLIB_STRATEGIES.get(strategy, zlib.Z_DEFAULT_STRATEGY))
+    return buf.getvalue()
+
+
+def decode_tile(data):
+    '''
+    解码png或webp瓦片
+    :return: (4, h, w)的RGBA数组, data为None时返回None
+    '''
+    if data is None:
+        return None
+    with Image.open(io.BytesIO(data)) as image:
+        return np.moveaxis(np.asarray(image.convert('RGBA')), -1, 0)
+
+
+_src = None
+
+_store = None
+
+_encoding = None
+
+_encoder = None
+
+
+def _init(input_file, output, encoding, encoders):
+    global _src, _store, _encoding, _encoder
+    _src = rasterio.open(input_file)
+    _encoding = encoding
+    _store = open_store(output, 'r', encoding['format'])
+    # 编码在单独的线程池中进行, 与下一个元瓦片的读取重叠, Pillow与zlib编码、rasterio读取时都释放GIL
+    _encoder = ThreadPoolExecutor(max(1, encoders))
+
+
+def _encode(tile):
+    start_time = time.perf_counter()
+    data = encode_tile(tile, **_encoding)
+    return data, time.perf_counter() - start_time
+
+
+def _collect(z, pending, result):
+    '''
+    等待已提交的编码完成, 目录直接写入, 单文件交由主进程写入
+    :param pending: [(x, y, future)]
+    :param result: [瓦片数, 字节数, 新内容数, 编码耗时, payloads], 原地累加
+    '''
+    for x, y, future in pending:
+        data, seconds = future.result()
+        result[0] += 1
+        result[1] += len(data)
+        result[3] += seconds
+        if _store.shared:
+            result[2] += _store.put(z, x, y, data)
+        else:
+            result[4].append((z, x, y, data))
+
+
+def _pipeline(z, jobs, produce):
+    '''
+    逐个元瓦片生成瓦片并提交编码, 不等待编码完成就开始下一个元瓦片的读取,
+    读取完成后再收取上一个元瓦片的编码结果, 同时最多保留两个元瓦片的数据
+    :param jobs: [(x, y, nx, ny)]
+    :param produce: produce(x, y, nx, ny), 返回([(x, y, rgba)], 跳过的瓦片数)
+    :return: (瓦片数, 跳过数, 字节数, 新内容数, 编码耗时, payloads), 编码耗时为各瓦片编码耗时之和
+    '''
+    result = [0, 0, 0, 0.0, []]
+    skipped = 0
+    pending = []
+    for job in jobs:
+        tiles, s = produce(*job)
+        skipped += s
+        current = [(x, y, _encoder.submit(_encode, rgba)) for x, y, rgba in tiles]
+        _collect(z, pending, result)
+        pending = current
+    _collect(z, pending, result)
+    written, size, unique, seconds, payloads = result
+    return written, skipped, size, unique, seconds, payloads
+
+
+def _read_tiles(z, x, y, nx, ny, tilesize):
+    skipped = 0
+    tiles = []
+    rgba = read_metatile(_src, z, x, y, nx, ny, tilesize)
+    for i in range(nx):
+        for j in range(ny):
+            tile = None if rgba is None else \
+                rgba[:, j * tilesize:(j + 1) * tilesize, i * tilesize:(i + 1) * tilesize]
+            # 全部为无数据的瓦片不输出
+            if tile is None or not tile[3].any():
+                skipped += 1
+                continue
+            tiles.append((x + i, y + j, tile))
+    return tiles, skipped
+
+
+def _cut(z, jobs, tilesize):
+    return _pipeline(z, jobs, lambda *job: _read_tiles(z, *job, tilesize))
+
+
+def derive_tile(get, z, x, y, tilesize=TILE_SIZE):
+    '''
+    由z+1级的4个子瓦片拼接后隔行隔列取样得到z级瓦片, 与最邻近重采样一致
+    :param get: get(z, x, y), 返回瓦片字节, 不存在时返回None
+    :return: (4, tilesize, tilesize)的RGBA数组, 全部为无数据时返回None
+    '''
+    mosaic = np.zeros((4, tilesize * 2, tilesize * 2), dtype='uint8')
+    for dx in (0, 1):
+        for dy in (0, 1):
+            child = decode_tile(get(z + 1, x * 2 + dx, y * 2 + dy))
+            if child is not None:
+                mosaic[:, dy * tilesize:(dy + 1) * tilesize, dx * tilesize:(dx + 1) * tilesize] = child
+    tile = mosaic[:, 1::2, 1::2]
+    return tile if tile[3].any() else None
+
+
+def _derive_tiles(z, x, y, nx, ny, tilesize):
+    skipped = 0
+    tiles = []
+    for i in range(nx):
+        for j in range(ny):
+            tile = derive_tile(_store.get, z, x + i, y + j, tilesize)
+            if tile is None:
+                skipped += 1
+                continue
+            tiles.append((x + i, y + j, tile))
+    return tiles, skipped
+
+
+def _derive(z, jobs, tilesize):
+    return _pipeline(z, jobs, lambda *job: _derive_tiles(z, *job, tilesize))
+
+
+def load_info(output):
+    '''
+    已有切片的信息, 不存在时返回None
+    '''
+    if not os.path.exists(output):
+        return None
+    store = open_store(output)
+    try:
+        return store.load_info()
+    finally:
+        store.close()
+
+
+def resumable(output, source, encoding=None):
+    '''
+    output中的切片是否由source以相同编码切出, 可在其基础上继续
+    '''
+    info = load_info(output)
+    return info is not None and source is not None and info.get('source') == source \
+        and info.get('encoding', DEFAULT_ENCODING) == (encoding or DEFAULT_ENCODING)
+
+
+def cut(input_file, output, zoom, processes=None, meta=8, tilesize=TILE_SIZE, incremental=True, progress=None,
+        source=None, encoding=None, encoders=1, batch=4):
+    '''
+    切XYZ瓦片, output为目录时输出{output}/{z}/{x}/{y}.png, 为.mbtiles时写入单个MBTiles文件
+    每个进程按元瓦片读取栅格, 一次读取后切出meta x meta个瓦片
+    每个任务为同一行中连续的batch个元瓦片, 进程内瓦片交给编码线程后即读取下一个元瓦片, 读取与编码重叠
+    级别从高到低处理, z+1级已完成时z级由子瓦片降采样得到, 不再读取栅格
+    每级先写入暂存区, 全部完成后整级提交并记入zooms, 读取方只会看到完整的级别
+    每完成一行元瓦片记录一次检查点, 中断后再次运行时跳过已完成的行
+    :param input_file: EPSG:3857的rgb栅格
+    :param zoom: 切片级别, 如'8-9'
+    :param processes: 进程数, 默认为全部核
+    :param meta: 元瓦片边长(瓦片数)
+    :param incremental: 保留已完成的级别, 只切缺少的级别
+    :param progress: 进度回调, progress(已完成元瓦片数, 元瓦片总数, prefix)
+    :param source: 输入栅格的标识(如内容哈希), 与已有切片记录的不同时全部重切
+    :param encoding: 瓦片编码选项, 见ENCODINGS, 默认为png, 与已有切片的不同时全部重切
+    :param encoders: 每个进程的编码线程数
+    :param batch: 每个任务的元瓦片数
+    :return: {z: {'tiles', 'skipped', 'bytes', 'unique', 'seconds', 'encode_seconds', 'derived'}}
+        unique为去重后实际写入的瓦片数, encode_seconds为各进程编码耗时之和
+    '''
+    encoding = encoding or DEFAULT_ENCODING
+    minzoom, maxzoom = parse_zoom(zoom)
+    with rasterio.open(input_file) as src:
+        bounds = src.bounds
+    store = open_store(output, 'w', encoding['format'])
+    info = store.load_info()
+    # 没有记录source的旧切片由调用方确认是否为最新
+    if not incremental or info is None or info['tilesize'] != tilesize or info.get('source', source) != source \
+            or info.get('encoding', DEFAULT_ENCODING) != encoding:
+        info = {'tilesize': tilesize, 'zooms': []}
+    if source is not None:
+        info['source'] = source
+    info['encoding'] = encoding
+    stats = {}
+    try:
+        with ProcessPoolExecutor(max_workers=processes or os.cpu_count(), initializer=_init,
+                                 initargs=(input_file, output, encoding, encoders)) as executor:
+            for z in range(maxzoom, minzoom - 1, -1):
+                if z in info['zooms']:
+                    print(f'zoom {z} is exists')
+                    continue
+                derived = z + 1 in info['zooms']
+                func = _derive if derived else _cut
+                start_time = time.time()
+                partial = info.get('partial')
+                if partial and partial['zoom'] == z and partial['derived'] == derived:
+                    done = set(partial['rows'])
+                    print(f'zoom {z} resumed, {len(done)} rows done')
+                else:
+                    done = set()
+                    store.discard(z)
+                    info['partial'] = {'zoom': z, 'derived': derived, 'rows': []}
+                    store.save_info(info)
+                # 同一行连续的batch个元瓦片为一个任务
+                tasks = []
+                for _, x, y, nx, ny in metatiles(bounds, z, meta):
+                    if y in done:
+                        continue
+                    if tasks and tasks[-1][0] == y and len(tasks[-1][1]) < batch:
+                        tasks[-1][1].append((x, y, nx, ny))
+                    else:
+                        tasks.append((y, [(x, y, nx, ny)]))
+                # 每行剩余的任务数, 为0时该行完成
+                rows = {}
+                for y, _ in tasks:
+                    rows[y] = rows.get(y, 0) + 1
+                futures = {executor.submit(func, z, jobs, tilesize): y for y, jobs in tasks}
+                written = skipped = size = unique = 0
+                encode_seconds = 0.0
+                for n, future in enumerate(as_completed(futures), 1):
+                    if progress:
+                        progress(n, len(futures), f' zoom {z}')
+                    w, s, b, u, e, payloads = future.result()
+                    for tile in payloads:
+                        u += store.put(*tile)
+                    written += w
+                    skipped += s
+                    size += b
+                    unique += u
+                    encode_seconds += e
+                    row = futures[future]
+                    rows[row] -= 1
+                    if not rows[row]:
+                        # 检查点, save_info会先写入缓冲的瓦片
+                        done.add(row)
+                        info['partial']['rows'] = sorted(done)
+                        store.save_info(info)
+                seconds = time.time() - start_time
+                store.commit(z)
+                info['zooms'] = sorted(info['zooms'] + [z])
+                info['partial'] = None
+                store.save_info(info)
+                stats[z] = {'tiles': written, 'skipped': skipped, 'bytes': size, 'unique': unique,
+                            'seconds': seconds, 'encode_seconds': encode_seconds, 'derived': derived}
+                print(f'zoom {z}{" (derived)" if derived else ""}: {written} tiles, {skipped} skipped, '
+                      f'{written / max(seconds, 1e-6):.1f} tiles/s, {size / 1048576:.1f} MB, '
+                      f'dedup {written / max(unique, 1):.1f}x, encode {encode_seconds:.1f}s')
+    finally:
+        store.close()
+    return stats
+
+
+def compare_encodings(input_file, zoom, encodings=None, count=32, tilesize=TILE_SIZE):
+    '''
+    取zoom级中有数据的count个瓦片, 比较各编码的大小与编解码速度
+    :param encodings: {名称: 编码选项}, 默认为ENCODINGS
+    :return: {名称: {'tiles', 'bytes', 'encode_ms', 'decode_ms', 'lossless'}}, 耗时为每个瓦片的毫秒数
+    '''
+    encodings = encodings or ENCODINGS
+    tiles = []
+    with rasterio.open(input_file) as src:
+        candidates = metatiles(src.bounds, zoom, 1)
+        # 均匀取样, 多取一些以跳过无数据的瓦片
+        step = max(1, len(candidates) // (count * 4))
+        for m in candidates[::step]:
+            rgba = read_metatile(src, *m, tilesize)
+            if rgba is not None and rgba[3].any():
+                tiles.append(rgba)
+                if len(tiles) >= count:
+                    break
+    result = {}
+    for name, encoding in encodings.items():
+        start_time = time.perf_counter()
+        datas = [encode_tile(tile, **encoding) for tile in tiles]
+        encode_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        decoded = [decode_tile(data) for data in datas]
+        decode_seconds = time.perf_counter() - start_time
+        # 透明像素的RGB不影响显示, 只比较不透明像素
+        lossless = all(np.array_equal(a[:, a[3] > 0], b[:, a[3] > 0]) and np.array_equal(a[3], b[3])
+                       for a, b in zip(tiles, decoded))
+        result[name] = {
+            'tiles': len(tiles),
+            'bytes': sum(map(len, datas)),
+            'encode_ms': encode_seconds * 1000 / max(len(tiles), 1),
+            'decode_ms': decode_seconds * 1000 / max(len(tiles), 1),
+            'lossless': lossless,
+        }
+    return result
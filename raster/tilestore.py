@@ -0,0 +1,588 @@
+import os
+import io
+import sys
+import json
+import gzip
+import shutil
+import struct
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from functools import lru_cache
+
+# 目录下记录切片信息的文件
+TILESET_FILE = 'tiles.json'
+
+# 目录下正在写入的级别所在的子目录, 完成后整体改名到{z}
+STAGING_DIR = '.staging'
+
+# PMTiles瓦片类型
+PMTILES_TYPES = {'png': 2, 'jpg': 3, 'webp': 4}
+
+
+def tile_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class DirectoryStore:
+    '''
+    {path}/{z}/{x}/{y}.{ext}目录
+    各进程可直接写入, 瓦片先写入{path}/.staging/{z}, commit时整级改名, 读取方不会看到写了一半的级别
+    内容相同的瓦片(如海洋)只写一次, 之后以硬链接指向第一次写出的文件
+    :param dedup: 最近写出的瓦片哈希保留数量, 0为不去重
+    '''
+    shared = True
+
+    def __init__(self, path, mode='r', ext='png', dedup=4096):
+        self.path = path
+        self.ext = ext
+        self.dedup = dedup
+        self.seen = OrderedDict()
+        self.staging = os.path.join(path, STAGING_DIR)
+        if mode != 'r':
+            os.makedirs(path, exist_ok=True)
+
+    def tile_path(self, z, x, y, staged=False):
+        return os.path.join(self.staging if staged else self.path, str(z), str(x), f'{y}.{self.ext}')
+
+    def get(self, z, x, y):
+        path = self.tile_path(z, x, y)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, z, x, y, data):
+        '''
+        写入瓦片, commit之前不可读取
+        :return: 是否写入了新内容, 去重时为False
+        '''
+        path = self.tile_path(z, x, y, staged=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 硬链接共享同一份数据, 只能先写临时文件再替换, 不能原地覆盖
+        tmp = f'{path}.{os.getpid()}.tmp'
+        key = tile_hash(data) if self.dedup else None
+        first = self.seen.get(key)
+        if first is not None:
+            try:
+                os.link(first, tmp)
+                os.replace(tmp, path)
+                self.seen.move_to_end(key)
+                return False
+            except OSError:
+                self.seen.pop(key, None)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        if key is not None:
+            self.seen[key] = path
+            if len(self.seen) > self.dedup:
+                self.seen.popitem(last=False)
+        return True
+
+    def tiles(self):
+        '''
+        遍历全部瓦片
+        :return: (z, x, y)迭代器
+        '''
+        for z in sorted(int(d) for d in os.listdir(self.path) if d.isdigit()):
+            zpath = os.path.join(self.path, str(z))
+            for x in sorted(int(d) for d in os.listdir(zpath) if d.isdigit()):
+                for name in os.listdir(os.path.join(zpath, str(x))):
+                    y, ext = os.path.splitext(name)
+                    if ext == f'.{self.ext}' and y.isdigit():
+                        yield z, x, int(y)
+
+    def load_info(self):
+        path = os.path.join(self.path, TILESET_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_info(self, info):
+        path = os.path.join(self.path, TILESET_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        os.replace(path + '.tmp', path)
+
+    def discard(self, z):
+        '''
+        丢弃z级未提交的瓦片
+        '''
+        shutil.rmtree(os.path.join(self.staging, str(z)), ignore_errors=True)
+
+    def commit(self, z):
+        '''
+        提交z级瓦片, 已有的同级目录先改名再删除
+        '''
+        src = os.path.join(self.staging, str(z))
+        if not os.path.isdir(src):
+            return
+        dst = os.path.join(self.path, str(z))
+        old = f'{dst}.old'
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(dst):
+            os.replace(dst, old)
+        os.replace(src, dst)
+        shutil.rmtree(old, ignore_errors=True)
+        try:
+            os.rmdir(self.staging)
+        except OSError:
+            pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MBTilesStore:
+    '''
+    MBTiles(SQLite)单文件
+    写入按批提交, 只能由一个进程写入, 其他进程可同时只读打开
+    瓦片按内容哈希存在images表, map表记录行列号到哈希的映射, tiles为视图
+    写入的映射先存在staging表, commit时整级移入map, 读取方不会看到写了一半的级别
+    :param batch: 每批插入的瓦片数
+    :param dedup: 最近写入的瓦片哈希保留数量, 命中时不再重复传入数据
+    '''
+    shared = False
+
+    def __init__(self, path, mode='r', ext='png', batch=1000, dedup=4096):
+        self.path = path
+        self.ext = ext
+        self.batch = batch
+        self.dedup = dedup
+        self.seen = OrderedDict()
+        self.pending = []
+        self.mode = mode
+        if mode == 'r':
+            self.db = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+            return
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # WAL模式下写入时其他进程仍可读取已提交的级别
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row);
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+            CREATE TABLE IF NOT EXISTS staging (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+            CREATE UNIQUE INDEX IF NOT EXISTS staging_index ON staging (zoom_level, tile_column, tile_row);
+        ''')
+        self.db.execute('''
+            CREATE VIEW IF NOT EXISTS tiles AS
+            SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_data
+            FROM map JOIN images ON map.tile_id = images.tile_id
+        ''')
+        self.db.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)', ('format', ext))
+        self.db.commit()
+
+    def get(self, z, x, y):
+        # MBTiles的行号为TMS, 自下而上
+        row = self.db.execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                              (z, x, (1 << z) - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def put(self, z, x, y, data):
+        '''
+        写入瓦片, commit之前不可读取
+        :return: 是否写入了新内容, 去重时为False
+        '''
+        key = tile_hash(data)
+        new = key not in self.seen
+        self.seen[key] = True
+        self.seen.move_to_end(key)
+        if len(self.seen) > self.dedup:
+            self.seen.popitem(last=False)
+        # images表以哈希为主键, 未命中缓存的重复内容由INSERT OR IGNORE去重
+        self.pending.append((z, x, (1 << z) - 1 - y, key, data if new else None))
+        if len(self.pending) >= self.batch:
+            self.flush()
+        return new
+
+    def tiles(self):
+        for z, x, row in self.db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles'):
+            yield z, x, (1 << z) - 1 - row
+
+    def load_info(self):
+        rows = dict(self.db.execute('SELECT name, value FROM metadata').fetchall())
+        if 'zooms' not in rows:
+            return None
+        info = {'tilesize': int(rows.get('tilesize', 512)), 'zooms': json.loads(rows['zooms'])}
+        for key in ('source', 'partial', 'encoding'):
+            if key in rows:
+                info[key] = json.loads(rows[key])
+        return info
+
+    def save_info(self, info):
+        self.flush()
+        zooms = info['zooms']
+        metadata = {'tilesize': info['tilesize'], 'zooms': json.dumps(zooms)}
+        for key in ('source', 'partial', 'encoding'):
+            if key in info:
+                metadata[key] = json.dumps(info[key])
+        if zooms:
+            metadata.update({'minzoom': min(zooms), 'maxzoom': max(zooms)})
+        self.db.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                            [(k, str(v)) for k, v in metadata.items()])
+        self.db.commit()
+
+    def flush(self):
+        if self.pending:
+            self.db.executemany('INSERT OR IGNORE INTO images VALUES (?, ?)',
+                                [(p[3], p[4]) for p in self.pending if p[4] is not None])
+            self.db.executemany('INSERT OR REPLACE INTO staging VALUES (?, ?, ?, ?)',
+                                [p[:4] for p in self.pending])
+            self.db.commit()
+            self.pending = []
+
+    def discard(self, z):
+        self.flush()
+        self.db.execute('DELETE FROM staging WHERE zoom_level=?', (z,))
+        self.db.commit()
+
+    def commit(self, z):
+        '''
+        提交z级瓦片, 在同一个事务中移入map表
+        '''
+        self.flush()
+        self.db.execute('INSERT OR REPLACE INTO map SELECT * FROM staging WHERE zoom_level=?', (z,))
+        self.db.execute('DELETE FROM staging WHERE zoom_level=?', (z,))
+        self.db.commit()
+
+    def close(self):
+        self.flush()
+        if self.mode != 'r':
+            try:
+                # 合并WAL, 保证交付的是单个文件
+                self.db.execute('PRAGMA journal_mode=DELETE')
+            except sqlite3.OperationalError:
+                pass
+        self.db.close()
+
+
+def zxy_to_tileid(z, x, y):
+    '''
+    PMTiles瓦片编号, 按级别累加后沿希尔伯特曲线编号
+    '''
+    acc = ((1 << (z * 2)) - 1) // 3
+    a = z - 1
+    while a >= 0:
+        s = 1 << a
+        rx = s & x
+        ry = s & y
+        acc += ((3 * rx) ^ ry) << a
+        if ry == 0:
+            if rx != 0:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        a -= 1
+    return acc
+
+
+def write_varint(buf, value):
+    while value >= 0x80:
+        buf.write(bytes([(value & 0x7F) | 0x80]))
+        value >>= 7
+    buf.write(bytes([value]))
+
+
+def read_varint(buf):
+    value = shift = 0
+    while True:
+        b = buf.read(1)[0]
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value
+        shift += 7
+
+
+def serialize_directory(entries):
+    '''
+    序列化PMTiles目录并gzip压缩
+    :param entries: [(tile_id, offset, length, run_length)], 按tile_id排序
+    '''
+    buf = io.BytesIO()
+    write_varint(buf, len(entries))
+    last = 0
+    for e in entries:
+        write_varint(buf, e[0] - last)
+        last = e[0]
+    for e in entries:
+        write_varint(buf, e[3])
+    for e in entries:
+        write_varint(buf, e[2])
+    for i, e in enumerate(entries):
+        # 与上一条数据连续时记0
+        if i > 0 and e[1] == entries[i - 1][1] + entries[i - 1][2]:
+            write_varint(buf, 0)
+        else:
+            write_varint(buf, e[1] + 1)
+    return gzip.compress(buf.getvalue())
+
+
+def deserialize_directory(data):
+    buf = io.BytesIO(gzip.decompress(data))
+    n = read_varint(buf)
+    ids = []
+    last = 0
+    for _ in range(n):
+        last += read_varint(buf)
+        ids.append(last)
+    runs = [read_varint(buf) for _ in range(n)]
+    lengths = [read_varint(buf) for _ in range(n)]
+    offsets = []
+    for i in range(n):
+        value = read_varint(buf)
+        offsets.append(offsets[i - 1] + lengths[i - 1] if value == 0 and i > 0 else value - 1)
+    return list(zip(ids, offsets, lengths, runs))
+
+
+def build_directories(entries, root_size=16384 - 127):
+    '''
+    根目录放不下时拆分叶目录
+    :return: (根目录, 叶目录)
+    '''
+    if len(entries) < 16384:
+        root = serialize_directory(entries)
+        if len(root) <= root_size:
+            return root, b''
+    leaf_size = 4096
+    while True:
+        leaves = io.BytesIO()
+        root_entries = []
+        for i in range(0, len(entries), leaf_size):
+            chunk = entries[i:i + leaf_size]
+            data = serialize_directory(chunk)
+            root_entries.append((chunk[0][0], leaves.tell(), len(data), 0))
+            leaves.write(data)
+        root = serialize_directory(root_entries)
+        if len(root) <= root_size:
+            return root, leaves.getvalue()
+        leaf_size *= 2
+
+
+HEADER = struct.Struct('<7sB11QBBBBBBiiiiBii')
+
+
+def write_pmtiles(store, path, ext='png', bounds=(-180, -85.0511, 180, 85.0511)):
+    '''
+    将瓦片写为PMTiles(v3)单文件, 瓦片按编号顺序排列
+    内容相同的瓦片只存一份, 编号连续且内容相同的瓦片合并为一条记录
+    :param store: 可读的瓦片存储
+    :param bounds: 经纬度范围
+    :return: (瓦片数, 不重复内容数)
+    '''
+    keys = sorted((zxy_to_tileid(z, x, y), z, x, y) for z, x, y in store.tiles())
+    entries = []
+    contents = {}
+    with tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path))) as data:
+        for tile_id, z, x, y in keys:
+            tile = store.get(z, x, y)
+            key = tile_hash(tile)
+            if key not in contents:
+                contents[key] = data.tell()
+                data.write(tile)
+            offset = contents[key]
+            last = entries[-1] if entries else None
+            if last and last[1] == offset and last[0] + last[3] == tile_id:
+                entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+            else:
+                entries.append((tile_id, offset, len(tile), 1))
+        data_length = data.tell()
+        root, leaves = build_directories(entries)
+        zooms = [k[1] for k in keys] or [0]
+        metadata = gzip.compress(json.dumps({'format': ext}).encode('utf-8'))
+        root_offset = HEADER.size
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        data_offset = leaves_offset + len(leaves)
+        header = HEADER.pack(
+            b'PMTiles', 3,
+            root_offset, len(root), metadata_offset, len(metadata), leaves_offset, len(leaves),
+            data_offset, data_length, len(keys), len(entries), len(contents),
+            1, 2, 1, PMTILES_TYPES.get(ext, 0), min(zooms), max(zooms),
+            int(bounds[0] * 1e7), int(bounds[1] * 1e7), int(bounds[2] * 1e7), int(bounds[3] * 1e7),
+            min(zooms), int((bounds[0] + bounds[2]) / 2 * 1e7), int((bounds[1] + bounds[3]) / 2 * 1e7))
+        with open(path + '.tmp', 'wb') as f:
+            f.write(header)
+            f.write(root)
+            f.write(metadata)
+            f.write(leaves)
+            data.seek(0)
+            shutil.copyfileobj(data, f, 16 * 1024 * 1024)
+    os.replace(path + '.tmp', path)
+    return len(keys), len(contents)
+
+
+class PMTilesStore:
+    '''
+    PMTiles(v3)单文件, 只读
+    '''
+    shared = False
+
+    def __init__(self, path, mode='r'):
+        if mode != 'r':
+            raise ValueError('PMTiles只能整体写出, 请写入MBTiles后用write_pmtiles转换')
+        self.path = path
+        self.file = open(path, 'rb')
+        # seek与read需成对执行, 多线程读取时加锁
+        self.lock = threading.Lock()
+        fields = HEADER.unpack(self.file.read(HEADER.size))
+        if fields[0] != b'PMTiles' or fields[1] != 3:
+            raise ValueError(f'不是PMTiles v3文件: {path}')
+        (self.root_offset, self.root_length, self.metadata_offset, self.metadata_length,
+         self.leaves_offset, self.leaves_length, self.data_offset, self.data_length) = fields[2:10]
+        self.ext = {v: k for k, v in PMTILES_TYPES.items()}.get(fields[16], 'png')
+        self.minzoom, self.maxzoom = fields[17], fields[18]
+        self.directory = lru_cache(maxsize=64)(self._directory)
+
+    def _read(self, offset, length):
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def _directory(self, offset, length):
+        entries = deserialize_directory(self._read(offset, length))
+        return [e[0] for e in entries], entries
+
+    def get(self, z, x, y):
+        tile_id = zxy_to_tileid(z, x, y)
+        offset, length = self.root_offset, self.root_length
+        for _ in range(4):
+            ids, entries = self.directory(offset, length)
+            i = bisect_right(ids, tile_id) - 1
+            if i < 0:
+                return None
+            entry = entries[i]
+            if entry[3] == 0:
+                offset, length = self.leaves_offset + entry[1], entry[2]
+                continue
+            if tile_id >= entry[0] + entry[3]:
+                return None
+            return self._read(self.data_offset + entry[1], entry[2])
+        return None
+
+    def tiles(self):
+        def walk(offset, length):
+            for tile_id, off, size, run in self.directory(offset, length)[1]:
+                if run == 0:
+                    yield from walk(self.leaves_offset + off, size)
+                else:
+                    for i in range(run):
+                        yield tile_id + i
+        for tile_id in walk(self.root_offset, self.root_length):
+            yield tileid_to_zxy(tile_id)
+
+    def load_info(self):
+        return {'tilesize': 512, 'zooms': list(range(self.minzoom, self.maxzoom + 1))}
+
+    def close(self):
+        self.file.close()
+
+
+def tileid_to_zxy(tile_id):
+    z = 0
+    acc = 0
+    while acc + (1 << (z * 2)) <= tile_id:
+        acc += 1 << (z * 2)
+        z += 1
+    t = tile_id - acc
+    x = y = 0
+    s = 1
+    n = 1 << z
+    while s < n:
+        rx = 1 & (t // 2)
+        ry = 1 & (t ^ rx)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        x += s * rx
+        y += s * ry
+        t //= 4
+        s *= 2
+    return z, x, y
+
+
+def open_store(path, mode='r', ext='png'):
+    '''
+    按扩展名打开瓦片存储, .mbtiles/.pmtiles为单文件, 其他为目录
+    :param mode: 'r'只读, 'w'写入
+    '''
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix == '.mbtiles':
+        return MBTilesStore(path, mode, ext)
+    if suffix == '.pmtiles':
+        return PMTilesStore(path, mode)
+    return DirectoryStore(path, mode, ext)
+
+
+def remove(path):
+    '''
+    删除瓦片目录或单文件
+    '''
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def replace(src, dst):
+    '''
+    以暂存的瓦片目录或单文件整体替换dst
+    单文件直接改名; 目录不能改名覆盖, 已有的dst先改名为{dst}.old, 替换后再删除
+    '''
+    if not os.path.isdir(src):
+        os.replace(src, dst)
+        return
+    old = f'{dst}.old'
+    remove(old)
+    if os.path.exists(dst):
+        os.replace(dst, old)
+    os.replace(src, dst)
+    remove(old)
+
+
+def convert(src, dst, ext='png'):
+    '''
+    瓦片格式转换, 如目录转MBTiles/PMTiles, MBTiles转PMTiles
+    :return: (瓦片数, 不重复内容数)
+    '''
+    source = open_store(src, 'r', ext)
+    try:
+        if os.path.splitext(dst)[1].lower() == '.pmtiles':
+            return write_pmtiles(source, dst, ext)
+        target = open_store(dst, 'w', ext)
+        count = unique = 0
+        zooms = set()
+        for z, x, y in source.tiles():
+            unique += bool(target.put(z, x, y, source.get(z, x, y)))
+            count += 1
+            zooms.add(z)
+        for z in sorted(zooms):
+            target.commit(z)
+        info = source.load_info()
+        if info:
+            target.save_info(info)
+        target.close()
+        return count, unique
+    finally:
+        source.close()
+
+
+if __name__ == '__main__':
+    # python tilestore.py G:/raster/raster/2022 G:/raster/raster/2022.pmtiles
+    if len(sys.argv) != 3:
+        print('usage: python tilestore.py <src> <dst>')
+        sys.exit(1)
+    count, unique = convert(sys.argv[1], sys.argv[2])
+    print(f'converted {count} tiles, {unique} unique, dedup {count / max(unique, 1):.1f}x: {sys.argv[2]}')
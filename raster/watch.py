@@ -0,0 +1,196 @@
+'''
+监视模式
+定时扫描path_main, 新增或修改的tif写入持久化的任务队列, 按并发上限依次重投影、rgb编码与切片
+队列保存在queue_path, 重启后未完成的任务继续执行
+
+python watch.py 0-5
+'''
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import main
+import metrics
+
+queue_path = r'G:/raster/queue.json'
+
+# 扫描间隔(秒)
+interval = 60
+
+# 有任务在处理时的扫描间隔(秒)
+busy_interval = 2
+
+# 失败任务的最大重试次数, 文件再次修改后重新计数
+max_attempts = 3
+
+
+class Queue:
+    '''
+    持久化的任务队列, 每个文件一个任务, 记录入队时的大小与修改时间
+    状态: pending待处理, running处理中, done完成, failed失败
+    :param path: 队列文件路径
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.jobs = json.load(f)['jobs']
+        # 上次退出时未完成的任务重新执行
+        for job in self.jobs.values():
+            if job['state'] == 'running':
+                job['state'] = 'pending'
+
+    def changed(self, path, stat):
+        '''
+        文件是否未入队或在入队后被修改
+        '''
+        with self.lock:
+            job = self.jobs.get(path)
+        return job is None or job['size'] != stat.st_size or job['mtime'] != stat.st_mtime_ns
+
+    def put(self, path, stat):
+        with self.lock:
+            self.jobs[path] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+                'state': 'pending',
+                'attempts': 0,
+                'queued': datetime.datetime.now().isoformat(timespec='seconds'),
+            }
+        self.save()
+
+    def take(self):
+        '''
+        取出最早入队的待处理任务, 没有时返回None
+        '''
+        with self.lock:
+            pending = [(job['queued'], path) for path, job in self.jobs.items() if job['state'] == 'pending']
+            if not pending:
+                return None
+            path = min(pending)[1]
+            job = self.jobs[path]
+            job['state'] = 'running'
+            job['attempts'] += 1
+        self.save()
+        return path
+
+    def finish(self, path, error=None):
+        with self.lock:
+            job = self.jobs[path]
+            if error is None:
+                job['state'] = 'done'
+                job.pop('error', None)
+            else:
+                job['error'] = error
+                job['state'] = 'pending' if job['attempts'] < max_attempts else 'failed'
+            job['finished'] = datetime.datetime.now().isoformat(timespec='seconds')
+        self.save()
+
+    def counts(self):
+        with self.lock:
+            result = {}
+            for job in self.jobs.values():
+                result[job['state']] = result.get(job['state'], 0) + 1
+            return result
+
+    def save(self):
+        with self.lock:
+            text = json.dumps({'jobs': self.jobs}, indent=2, ensure_ascii=False)
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            tmp = f'{self.path}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp, self.path)
+
+
+def scan(path):
+    '''
+    目录下的tif文件
+    :return: {路径: stat}
+    '''
+    result = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(('.tif', '.tiff')):
+                result[os.path.normpath(entry.path)] = entry.stat()
+    return result
+
+
+def process(file, zoom, cpu):
+    '''
+    重投影与rgb编码后切片, 已是最新的产物由清单跳过
+    '''
+    rgbtif = main.reproject_rgbify(file, cpu)
+    main.tiles(rgbtif, zoom, processes=cpu)
+
+
+def watch(zoom='0-5', jobs=2, max_cpu=None):
+    '''
+    持续监视path_main
+    :param zoom: 切片级别
+    :param jobs: 同时处理的文件数
+    :param max_cpu: 核数预算, 平均分给各任务, 默认为全部核
+    '''
+    for path in (main.rgb_path, main.tiles_path):
+        os.makedirs(path, exist_ok=True)
+    queue = Queue(queue_path)
+    cpu = max(1, (max_cpu or os.cpu_count() or 1) // jobs)
+    seen = {}
+    running = set()
+    main.report = metrics.Report()
+
+    def run(file):
+        name = os.path.basename(file)
+        print(f'\n{name} 开始处理')
+        start_time = time.time()
+        try:
+            process(file, zoom, cpu)
+        except Exception as e:
+            print(f'{name} 处理失败: {e}')
+            queue.finish(file, str(e))
+        else:
+            queue.finish(file)
+            print(f'{name} 已发布, 耗时: {main.format_seconds(time.time() - start_time)}')
+        finally:
+            running.discard(file)
+
+    print(f'监视 {main.path_main}, 队列: {queue.counts()}')
+    with ThreadPoolExecutor(jobs) as executor:
+        while True:
+            if os.path.exists(main.path_main):
+                files = scan(main.path_main)
+                for file, stat in files.items():
+                    last = seen.get(file)
+                    seen[file] = (stat.st_size, stat.st_mtime_ns)
+                    if file in running or not queue.changed(file, stat):
+                        continue
+                    # 大小与修改时间在两次扫描间不变才入队, 避免处理正在复制的文件
+                    if last == seen[file]:
+                        print(f'入队: {os.path.basename(file)}')
+                        queue.put(file, stat)
+                seen = {file: seen[file] for file in files}
+            while len(running) < jobs:
+                file = queue.take()
+                if file is None:
+                    break
+                if not os.path.exists(file):
+                    queue.finish(file, 'file not found')
+                    continue
+                running.add(file)
+                executor.submit(run, file)
+            if not running and main.report.stages:
+                # 队列处理完后保存本批次的报告
+                path = main.report.save(main.report_path)
+                print(f'队列已处理完, 报告: {path}, 队列: {queue.counts()}')
+                main.report = metrics.Report()
+            time.sleep(busy_interval if running else interval)
+
+
+if __name__ == '__main__':
+    watch(sys.argv[1] if len(sys.argv) > 1 else '0-5')